@@ -0,0 +1,49 @@
+"""
+A bloom filter for answering "never seen" without
+touching the database for the most of the lookups.
+"""
+import math
+import hashlib
+
+
+class BloomFilter:
+    "A fixed size bloom filter with double hashing"
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self._size = 0
+
+        bit_count = -self.capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._bit_count = max(int(math.ceil(bit_count)), 8)
+        self._hash_count = max(
+            int(round(self._bit_count / self.capacity * math.log(2))), 1
+        )
+        self._bits = bytearray((self._bit_count + 7) // 8)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def is_full(self):
+        "Returns True if the false positive rate exceeds the planned one"
+        return self._size > self.capacity
+
+    def _positions(self, item):
+        digest = hashlib.md5(str(item).encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for index in range(self._hash_count):
+            yield (first + index * second) % self._bit_count
+
+    def add(self, item):
+        "Adds the item into the filter"
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._size += 1
+
+    def __contains__(self, item):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
@@ -60,6 +60,9 @@ def listen_exceptions():
 
         time.sleep(1)
 
+    # Let the non-daemonic slave finish its cycle and exit
+    Q.state = False
+
     error = json.loads(error)
     if error is not None:
         raw_print(''.join(error))
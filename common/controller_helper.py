@@ -138,7 +138,9 @@ class ConsoleCommandExecutor:
                 self.queue, SLAVE_EXCEPTION_HANDLER
             ),
             name="SlaveInstagram",
-            daemon=True
+            # The slave runs a pool of duplicate checkers,
+            # daemonic processes are not allowed to have children
+            daemon=False
         )
         master_instagram = Process(
             target=module_process_starter,
@@ -261,6 +263,7 @@ class ConsoleCommandExecutor:
         try:
             logger.debug("Clearing the shared media")
             shutil.rmtree(settings.SHARED, ignore_errors=True)
+            os.unlink(settings.FINGERPRINT_INDEX)
         except FileNotFoundError:
             pass
 
@@ -65,3 +65,12 @@ class UnknownMediaExtension(BaseAPIException):
 
 class UnknownMediaType(BaseAPIException):
     "Raises when given media type is not valid"
+
+
+class DownloadFailed(BaseAPIException):
+    "Raises when a media could not be downloaded"
+
+    def __init__(self, url, reason):
+        super().__init__(
+            f"Download of {url} failed: {reason}"
+        )
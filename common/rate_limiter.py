@@ -0,0 +1,47 @@
+"""
+A token bucket shared by the threads that make
+requests with the same account.
+"""
+import time
+import threading
+
+
+class TokenBucket:
+    "Allows rate requests per second on average and bursts up to capacity"
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def acquire(self):
+        "Blocks until a token is available and takes it"
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait_time = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        "Stops giving tokens for the given seconds, e.g. on a server warning"
+        with self._lock:
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds
+            )
+            self._tokens = 0
+            self._updated_at = self._paused_until
@@ -2,12 +2,21 @@
 import sys
 import os
 import time
+import shutil
 import tempfile
 import logging
 import urllib
 from multiprocessing import Queue
 from pyreadline import Readline
 
+try:
+    import fcntl
+    msvcrt = None  # pylint: disable=invalid-name
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
 import settings
 from common import exceptions
 from common.logger import logger
@@ -213,3 +222,66 @@ class Lock(LockDir):
 
     def __init__(self):
         super().__init__(tempfile.gettempdir())
+
+
+class FileLock:
+    """
+        An exclusive lock held on the file across the processes, it is
+        released by the system if the holder dies. Not reentrant.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def _lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                # Gives up after 10 seconds
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+    def acquire(self):
+        "Waits until the lock is acquired"
+        # pylint: disable=consider-using-with
+        self._file = open(self.path, "a+b")
+        try:
+            self._file.seek(0)
+            self._lock()
+        except BaseException:
+            self._file.close()
+            raise
+
+    def release(self):
+        "Releases the lock"
+        # Closing releases the lock
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
+
+
+def remove_folder(path):
+    """
+        Moves the folder next to its parent, then removes it. rmtree
+        deletes the lock file while the other files still exist, the
+        lock watchers would take the half removed folder as released.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    trash = tempfile.mkdtemp(
+        prefix=".removing_", dir=os.path.dirname(parent)
+    )
+    try:
+        os.replace(path, os.path.join(trash, os.path.basename(path)))
+    finally:
+        shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,170 @@
+"""
+Wakes the master when a downloads folder is unlocked.
+
+On Linux the lock file deletions are watched with inotify, so
+a ready folder is noticed at once without any polling. On the
+other platforms the watcher only waits the timeout.
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+from common.logger import logger
+from common.tools import LockDir
+
+# Flags from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct("iIII")
+_BUFFER_SIZE = 64 * 1024
+
+# pylint: disable=protected-access
+LOCK_FILE = LockDir._LOCK_FILE
+
+
+class PollingWatcher:
+    "Reports no change, the caller checks the folder on each timeout"
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def wait(timeout):
+        "Waits the timeout, returns False"
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        "Nothing to release"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+class InotifyWatcher:
+    """
+        Watches the folder for the new subfolders and the subfolders
+        for the lock file deletions. inotify is not recursive, so each
+        subfolder has its own watch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise self._os_error()
+        # Watch descriptors of the subfolders to their names
+        self._folders = {}
+        self._root = self._add_watch(path, IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM)
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                self._watch_folder(name)
+
+    @staticmethod
+    def _os_error():
+        error_number = ctypes.get_errno()
+        return OSError(error_number, os.strerror(error_number))
+
+    def _add_watch(self, path, mask):
+        watch = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), mask | IN_ONLYDIR
+        )
+        if watch < 0:
+            raise self._os_error()
+        return watch
+
+    def _watch_folder(self, name):
+        try:
+            watch = self._add_watch(os.path.join(self.path, name), IN_DELETE)
+        except OSError as error:
+            if error.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            # Removed before the watch is added
+            return
+        self._folders[watch] = name
+
+    def _unwatch_folder(self, name):
+        for watch, folder in list(self._folders.items()):
+            if folder == name:
+                # The watch follows the folder to its new place
+                self._libc.inotify_rm_watch(self._fd, watch)
+                del self._folders[watch]
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, _BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield watch, mask, name
+
+    def wait(self, timeout):
+        "Waits a lock release until the timeout, returns True if any"
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+
+        is_released = False
+        for watch, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Some events are lost, the caller should check anyway
+                is_released = True
+            elif watch == self._root:
+                if not mask & IN_ISDIR:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_folder(name)
+                else:
+                    self._unwatch_folder(name)
+            elif mask & IN_IGNORED:
+                # The subfolder is removed
+                self._folders.pop(watch, None)
+            elif mask & IN_DELETE and name == LOCK_FILE:
+                logger.debug("%s is unlocked", self._folders.get(watch))
+                is_released = True
+        return is_released
+
+    def close(self):
+        "Closes the inotify instance with its watches"
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+def watch_lock_releases(path):
+    "Returns the inotify watcher if it is available, the polling one if not"
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as error:
+            logger.warning("inotify is not available: %s", error)
+    return PollingWatcher(path)
@@ -0,0 +1,240 @@
+"""
+Benchmarks the duplicate checker on a synthetic archive.
+
+Generates N random images as the shared archive, then queries
+near-duplicates of them (crop, recompression, brightness shift)
+and unseen images. Reports the throughput, the latency percentiles,
+the peak RSS, the precision/recall and the recall of each perturbation
+for each archive size.
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+import numpy
+from cv2 import cv2
+
+from common.tools import raw_print
+from common.logger import logger
+from instagram import duplicate
+from instagram.duplicate import FingerprintIndex, is_any_photo_shared, \
+    use_index
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+IMAGE_SIZE = 320
+PERTURBATIONS = ("crop", "recompress", "brightness")
+
+RESULT_FORMAT = (
+    "{0:>8}"   # Archive size
+    "{1:>10}"  # Method
+    "{2:>10}"  # Index build
+    "{3:>10}"  # Throughput
+    "{4:>9}"   # p50
+    "{5:>9}"   # p95
+    "{6:>9}"   # p99
+    "{7:>10}"  # Peak RSS
+    "{8:>10}"  # Precision
+    "{9:>8}"   # Recall
+    "{10:>8}"  # Crop recall
+    "{11:>8}"  # Recompress recall
+    "{12:>8}"  # Brightness recall
+)
+
+
+def random_image(rng):
+    "Returns a random image made of blurred noise and a few shapes"
+    image = rng.randint(0, 256, (IMAGE_SIZE // 8, IMAGE_SIZE // 8, 3))
+    image = cv2.resize(
+        image.astype(numpy.uint8), (IMAGE_SIZE, IMAGE_SIZE),
+        interpolation=cv2.INTER_CUBIC
+    )
+    for _ in range(rng.randint(3, 8)):
+        center = tuple(int(value) for value in rng.randint(0, IMAGE_SIZE, 2))
+        color = tuple(int(value) for value in rng.randint(0, 256, 3))
+        cv2.circle(image, center, int(rng.randint(10, 80)), color, -1)
+    return image
+
+
+def perturb(image, perturbation, rng):
+    "Returns a near-duplicate of the image"
+    if perturbation == "crop":
+        margin = int(IMAGE_SIZE * rng.uniform(0.05, 0.15))
+        return image[margin:IMAGE_SIZE - margin, margin:IMAGE_SIZE - margin]
+    if perturbation == "recompress":
+        _, encoded = cv2.imencode(
+            ".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(rng.randint(20, 40))]
+        )
+        return cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    if perturbation == "brightness":
+        shift = int(rng.randint(15, 40))
+        return cv2.add(image, numpy.full(image.shape, shift, numpy.uint8))
+    raise ValueError(perturbation)
+
+
+def create_archive(root, size, rng):
+    "Writes size images in the shared folder layout, returns their paths"
+    paths = []
+    for index in range(size):
+        folder = os.path.join(root, f"shared_images_{index}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"0_{index}_benchmark.jpg")
+        cv2.imwrite(path, random_image(rng))
+        paths.append(path)
+    return paths
+
+
+def create_queries(root, archive, count, rng):
+    """
+        Writes count query folders, half of them has a near-duplicate
+        of an archived image. Returns (folder, perturbation) pairs, the
+        perturbation is None for the unseen images.
+    """
+    queries = []
+    for index in range(count):
+        folder = os.path.join(root, f"downloaded_images_{index}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"0_{index}_benchmark.jpg")
+
+        perturbation = None
+        if index % 2 == 0:
+            perturbation = PERTURBATIONS[index // 2 % 3]
+            original = cv2.imread(random.choice(archive))
+            image = perturb(original, perturbation, rng)
+        else:
+            image = random_image(rng)
+        cv2.imwrite(path, image)
+        queries.append((folder, perturbation))
+    return queries
+
+
+def peak_rss_mb():
+    "Returns the peak resident set size of the process in MB"
+    if resource is None:
+        return float("nan")
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(workdir, size, query_count, methods, rng):
+    "Runs the benchmark for an archive size, yields a result row per method"
+    archive_root = os.path.join(workdir, f"shared_{size}")
+    archive = create_archive(archive_root, size, rng)
+    queries = create_queries(
+        os.path.join(workdir, f"downloads_{size}"), archive, query_count, rng
+    )
+
+    start_time = time.perf_counter()
+    index = FingerprintIndex(
+        path=os.path.join(workdir, f"fingerprints_{size}.npz"),
+        root=archive_root
+    )
+    index.sync()
+    use_index(index)
+    build_time = time.perf_counter() - start_time
+
+    for method in methods:
+        duplicate.DUPLICATE_METHOD = method
+        yield _measure(queries, size, method, build_time)
+
+
+def _measure(queries, size, method, build_time):
+    latencies = []
+    true_positives = false_positives = false_negatives = 0
+    # (found, total) of the near-duplicates of each perturbation
+    perturbation_counts = {name: [0, 0] for name in PERTURBATIONS}
+    for folder, perturbation in queries:
+        is_duplicate = perturbation is not None
+        start_time = time.perf_counter()
+        is_found = is_any_photo_shared(folder)
+        latencies.append(time.perf_counter() - start_time)
+
+        true_positives += is_found and is_duplicate
+        false_positives += is_found and not is_duplicate
+        false_negatives += is_duplicate and not is_found
+        if is_duplicate:
+            perturbation_counts[perturbation][0] += is_found
+            perturbation_counts[perturbation][1] += 1
+
+    latencies = numpy.array(latencies) * 1000
+    return RESULT_FORMAT.format(
+        size, method,
+        f"{build_time:.2f}s",
+        f"{len(queries) / (latencies.sum() / 1000):.1f}/s",
+        f"{numpy.percentile(latencies, 50):.1f}ms",
+        f"{numpy.percentile(latencies, 95):.1f}ms",
+        f"{numpy.percentile(latencies, 99):.1f}ms",
+        f"{peak_rss_mb():.0f}MB",
+        f"{true_positives / max(true_positives + false_positives, 1):.2f}",
+        f"{true_positives / max(true_positives + false_negatives, 1):.2f}",
+        *(f"{found / max(total, 1):.2f}"
+          for found, total in perturbation_counts.values())
+    )
+
+
+def main():
+    "Starts from here"
+    args = get_args()
+    rng = numpy.random.RandomState(args.seed)
+    random.seed(args.seed)
+    # Matches are logged as warnings, keep the log file quiet
+    logger.setLevel(logging.ERROR)
+
+    raw_print(RESULT_FORMAT.format(
+        "Archive", "Method", "Build", "Speed",
+        "p50", "p95", "p99", "Peak RSS", "Precision", "Recall",
+        "Crop", "Recomp", "Bright"
+    ))
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            for row in run(workdir, size, args.queries, args.methods, rng):
+                raw_print(row)
+
+
+def get_args():
+    "Parses the command line arguments"
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "-s", "--sizes",
+        nargs=argparse.ONE_OR_MORE,
+        type=int,
+        default=[100, 1000, 5000]
+    )
+
+    parser.add_argument(
+        "-q", "--queries",
+        type=int,
+        default=100
+    )
+
+    parser.add_argument(
+        "-m", "--methods",
+        nargs=argparse.ONE_OR_MORE,
+        choices=("histogram", "hash", "cascade"),
+        default=["histogram", "hash", "cascade"]
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0
+    )
+
+    parser.add_argument(
+        "--workdir",
+        default=None
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
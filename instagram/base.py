@@ -1,23 +1,31 @@
 """
 A instagram user base
 """
+import os
 import time
+import calendar
 import json
-import math
-import copy
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from requests_toolbelt import MultipartEncoder
-from moviepy.editor import VideoFileClip
 from InstagramAPI import InstagramAPI
 
 from common.logger import logger
 from common import exceptions
+from common.rate_limiter import TokenBucket
+from instagram.video_probe import video_info
+import settings
 
 from instagram_database.db import get_realtime_setting
 
 MEDIA_TYPE_PHOTO_EXT = ".jpg"
 MEDIA_TYPE_VIDEO_EXT = ".mp4"
 
+CHUNK_BACKOFF = 1  # Seconds, doubled on each retry of a video chunk
+
 
 class MediaTypes:
     "Types of the media"
@@ -66,10 +74,53 @@ class BaseInstagram(InstagramAPI):
     "Base for instagram user"
 
     def __init__(self, username, password, queue=None, **kwargs):
+        # Every request of the account passes through the same bucket
+        self.rate_limiter = TokenBucket(
+            settings.REQUESTS_PER_SECOND, settings.REQUEST_BURST
+        )
+        # The responses are kept per thread, so the requests can run
+        # concurrently without overwriting each other's LastJson
+        self._local = threading.local()
         super().__init__(username, password, **kwargs)
         self.queue = queue
         self._is_active = False
 
+    # pylint: disable=invalid-name
+    @property
+    def s(self):
+        "Returns the http session of the api"
+        return self._session
+
+    @s.setter
+    def s(self, session):
+        request = session.request
+
+        def _rate_limited_request(*args, **kwargs):
+            self.rate_limiter.acquire()
+            return request(*args, **kwargs)
+
+        session.request = _rate_limited_request
+        self._session = session
+
+    @property
+    def LastJson(self):
+        "Returns the json of the last response of the thread"
+        return getattr(self._local, "last_json", None)
+
+    @LastJson.setter
+    def LastJson(self, value):
+        self._local.last_json = value
+
+    @property
+    def LastResponse(self):
+        "Returns the last response of the thread"
+        return getattr(self._local, "last_response", None)
+
+    @LastResponse.setter
+    def LastResponse(self, value):
+        self._local.last_response = value
+    # pylint: enable=invalid-name
+
     @property
     def is_active(self):
         "Returns the status of process"
@@ -112,6 +163,19 @@ class BaseInstagram(InstagramAPI):
         if self.is_active:
             logger.debug("Time is up.")
 
+    def _wait_until(self, wake_time):
+        "Waits until the given epoch time with a log."
+        while self.is_active:
+            remaining_time = wake_time - calendar.timegm(time.gmtime())
+            if remaining_time <= 0:
+                break
+
+            logger.debug("Waiting... %d seconds remained.", remaining_time)
+            # Log every `WAIT_SECS` seconds
+            time.sleep(min(
+                get_realtime_setting("WAIT_SECS", int, 10), remaining_time
+            ))
+
     def start(self):
         "Starts the program"
         # Try to login
@@ -140,89 +204,160 @@ class BaseInstagram(InstagramAPI):
             self.deleteMedia(post["id"])
 
     def upload_video(self, video, thumbnail, **kwargs):
-        "Uploads the given video on instagram"
-        if kwargs.pop("upload_id", None) is None:
-            upload_id = str(int(time.time() * 1000))
+        "Uploads the given video on instagram, waits its transcode"
+        # Only for the upload, the configure takes the others
+        upload_id = self.send_video(
+            video, thumbnail, upload_id=kwargs.pop("upload_id", None),
+            is_sidecar=kwargs.pop("is_sidecar", False), **kwargs
+        )
+        if upload_id is None:
+            return False
+        return self.wait_transcode(upload_id, video, **kwargs)
+
+    # pylint: disable=too-many-arguments
+    def send_video(self, video, thumbnail, upload_id=None, is_sidecar=False,
+                   **kwargs):
+        """
+            Uploads the video and its thumbnail. Returns the upload id
+            to configure when the video is transcoded, None on failure.
+        """
+        upload_id = upload_id or str(int(time.time() * 1000))
         data = {'upload_id': upload_id,
                 '_csrftoken': self.token,
                 'media_type': '2',
                 '_uuid': self.uuid}
-        if kwargs.pop("is_sidecar", None):
+        if is_sidecar:
             data['is_sidecar'] = '1'
         multipart_encoder = MultipartEncoder(data, boundary=self.uuid)
-        self.s.headers.update({'X-IG-Capabilities': '3Q4=',
-                               'X-IG-Connection-Type': 'WIFI',
-                               'Host': 'i.instagram.com',
-                               'Cookie2': '$Version=1',
-                               'Accept-Language': 'en-US',
-                               'Accept-Encoding': 'gzip, deflate',
-                               'Content-type': multipart_encoder.content_type,
-                               'Connection': 'keep-alive',
-                               'User-Agent': self.USER_AGENT})
+        # The headers are given per request, the session is shared
+        # with the other threads
+        headers = {'X-IG-Capabilities': '3Q4=',
+                   'X-IG-Connection-Type': 'WIFI',
+                   'Host': 'i.instagram.com',
+                   'Cookie2': '$Version=1',
+                   'Accept-Language': 'en-US',
+                   'Accept-Encoding': 'gzip, deflate',
+                   'Content-type': multipart_encoder.content_type,
+                   'Connection': 'keep-alive',
+                   'User-Agent': self.USER_AGENT}
         response = self.s.post(
-            self.API_URL + "upload/video/", data=multipart_encoder.to_string()
+            self.API_URL + "upload/video/", data=multipart_encoder.to_string(),
+            headers=headers
         )
-        if response.status_code == 200:
-            return self._upload_video(
-                video, thumbnail, upload_id, json.loads(response.text), **kwargs
-            )
-        return False
+        if response.status_code != 200 or not self._upload_video(
+                video, upload_id, json.loads(response.text)):
+            return None
 
-    # pylint: disable=too-many-locals
-    def _upload_video(self, video, thumbnail, upload_id, body, **kwargs):
-        upload_url = body['video_upload_urls'][3]['url']
-        upload_job = body['video_upload_urls'][3]['job']
+        # Once, not on each configure retry
+        self.uploadPhoto(
+            photo=thumbnail, caption=kwargs.get("caption", ''),
+            upload_id=upload_id
+        )
+        return upload_id
+
+    def wait_transcode(self, upload_id, video, **kwargs):
+        """
+            Configures the video as soon as the server transcodes it.
+            Retries with an exponential backoff until the deadline.
+        """
+        deadline = time.monotonic() + settings.TRANSCODE_DEADLINE_S
+        wait_s = settings.TRANSCODE_WAIT_S
+        while True:
+            time.sleep(wait_s)
+            if self.configure_video(upload_id, video, **kwargs):
+                return self.expose()
 
-        video_data = open(video, 'rb').read()
-        request_size = int(math.floor(len(video_data) / 4))
-        last_request_extra = (len(video_data) - (request_size * 3))
-
-        headers = copy.deepcopy(self.s.headers)
-        self.s.headers.update({'X-IG-Capabilities': '3Q4=',
-                               'X-IG-Connection-Type': 'WIFI',
-                               'Cookie2': '$Version=1',
-                               'Accept-Language': 'en-US',
-                               'Accept-Encoding': 'gzip, deflate',
-                               'Content-type': 'application/octet-stream',
-                               'Session-ID': upload_id,
-                               'Connection': 'keep-alive',
-                               'Content-Disposition': 'attachment; filename="video.mov"',
-                               'job': upload_job,
-                               'Host': 'upload.instagram.com',
-                               'User-Agent': self.USER_AGENT})
-        for i in range(0, 4):
-            start = i * request_size
-            if i == 3:
-                end = i * request_size + last_request_extra
-                length = last_request_extra
-            else:
-                end = (i + 1) * request_size
-                length = request_size
-            content_range = "bytes {start}-{end}/{video_length}".format(
-                start=start, end=(end - 1), video_length=len(video_data)
-            ).encode('utf-8')
-
-            self.s.headers.update({
-                'Content-Length': str(end - start), 'Content-Range': content_range,
-            })
-            response = self.s.post(
-                upload_url,
-                data=video_data[start:start + length]
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                logger.error("The video %s is not transcoded in time", video)
+                return False
+            wait_s = min(wait_s * 2, remaining_time)
+            logger.debug(
+                "The video is not transcoded yet, retrying in %d seconds",
+                wait_s
             )
-        self.s.headers = headers
 
-        if response.status_code == 200:
-            # Wait 60 seconds to to be finised the transcode
-            time.sleep(60)
-            if self.configure_video(upload_id, video, thumbnail, **kwargs):
-                return self.expose()
+    def _upload_session(self):
+        """
+            Returns a session with the cookies and the proxies of the
+            api. The chunks go to the upload host, so they are not
+            throttled by the rate limiter of the api requests.
+        """
+        session = requests.Session()
+        session.cookies.update(self.s.cookies)
+        session.proxies.update(self.s.proxies)
+        return session
+
+    # pylint: disable=too-many-arguments
+    def _upload_chunk(self, post, headers, video, start, video_size):
+        """
+            Reads a chunk of the video from the disk and uploads it with
+            post. Retries only the chunk on failure, returns True on success.
+        """
+        chunk = bytearray(min(settings.VIDEO_CHUNK_SIZE, video_size - start))
+        with open(video, 'rb') as video_file:
+            video_file.seek(start)
+            video_file.readinto(chunk)
+        end = start + len(chunk)
+
+        headers = dict(headers)
+        headers['Content-Range'] = "bytes {start}-{end}/{video_length}".format(
+            start=start, end=(end - 1), video_length=video_size
+        )
+        for attempt in range(1, settings.VIDEO_CHUNK_ATTEMPTS + 1):
+            try:
+                # Sent from the buffer without a copy
+                response = post(data=memoryview(chunk), headers=headers)
+                if response.status_code == 200:
+                    return True
+                reason = response.status_code
+            except requests.RequestException as error:
+                reason = error
+            logger.warning(
+                "Video chunk %s failed(%d): %s",
+                headers['Content-Range'], attempt, reason
+            )
+            if attempt < settings.VIDEO_CHUNK_ATTEMPTS:
+                time.sleep(CHUNK_BACKOFF * 2 ** (attempt - 1))
         return False
 
-    def configure_video(self, upload_id, video, thumbnail, **kwargs):
-        "Prepares video before expose"
-        clip = VideoFileClip(video)
+    def _upload_video(self, video, upload_id, body):
+        "Uploads the chunks of the video, returns True on success"
+        upload_url = body['video_upload_urls'][3]['url']
+        upload_job = body['video_upload_urls'][3]['job']
+
+        headers = {'X-IG-Capabilities': '3Q4=',
+                   'X-IG-Connection-Type': 'WIFI',
+                   'Cookie2': '$Version=1',
+                   'Accept-Language': 'en-US',
+                   'Accept-Encoding': 'gzip, deflate',
+                   'Content-type': 'application/octet-stream',
+                   'Session-ID': upload_id,
+                   'Connection': 'keep-alive',
+                   'Content-Disposition': 'attachment; filename="video.mov"',
+                   'job': upload_job,
+                   'Host': 'upload.instagram.com',
+                   'User-Agent': self.USER_AGENT}
+
+        # Only VIDEO_CHUNK_WORKERS chunks are in the memory at a time
+        video_size = os.path.getsize(video)
+        with self._upload_session() as session, ThreadPoolExecutor(
+                max_workers=settings.VIDEO_CHUNK_WORKERS,
+                thread_name_prefix="video_chunk") as executor:
+            results = list(executor.map(
+                lambda start: self._upload_chunk(
+                    functools.partial(session.post, upload_url),
+                    headers, video, start, video_size
+                ),
+                range(0, video_size, settings.VIDEO_CHUNK_SIZE)
+            ))
+
+        return all(results)
+
+    def configure_video(self, upload_id, video, **kwargs):
+        "Prepares video before expose, fails until the video is transcoded"
+        info = video_info(video)
         caption = kwargs.pop("caption", '')
-        self.uploadPhoto(photo=thumbnail, caption=caption, upload_id=upload_id)
         data = json.dumps({
             'upload_id': upload_id,
             'source_type': 3,
@@ -232,13 +367,13 @@ class BaseInstagram(InstagramAPI):
             'filter_type': 0,
             'video_result': 'deprecated',
             'clips': {
-                'length': clip.duration,
+                'length': info.duration,
                 'source_type': '3',
                 'camera_position': 'back',
             },
             'extra': {
-                'source_width': clip.size[0],
-                'source_height': clip.size[1],
+                'source_width': info.width,
+                'source_height': info.height,
             },
             'device': self.DEVICE_SETTINTS,
             '_csrftoken': self.token,
@@ -246,8 +381,6 @@ class BaseInstagram(InstagramAPI):
             '_uid': self.username_id,
             'caption': caption,
         })
-        clip.reader.close()
-        clip.audio.reader.close_proc()
         return self.SendRequest('media/configure/?video=1', self.generateSignature(data))
 
     def _start(self):
@@ -0,0 +1,96 @@
+"""
+Runs the duplicate checks of the downloaded folders in
+worker processes, so the slave keeps downloading while
+the images are decoded and compared.
+"""
+import time
+from multiprocessing import Pool
+
+from common.logger import logger
+from common.tools import remove_folder
+from instagram.duplicate import is_any_photo_shared
+
+CHECK_ATTEMPTS = 3
+
+
+def _remove_folder(path):
+    "Removes the folder, never raises since it runs in the result thread"
+    for _ in range(10):
+        try:
+            remove_folder(path)
+        except FileNotFoundError:
+            break
+        except PermissionError:
+            time.sleep(0.5)
+        except OSError as error:
+            logger.error("%s could not be removed: %s", path, error)
+            break
+        else:
+            break
+
+
+class DedupPool:
+    "A pool of processes checks the downloaded folders asynchronously"
+
+    def __init__(self, processes=None):
+        # Lives until close, not in a with block
+        self._pool = Pool(processes)  # pylint: disable=consider-using-with
+        self._pending = {}
+        self._is_closed = False
+
+    @property
+    def pending_count(self):
+        "Returns the count of the folders waiting for a result"
+        return len(self._pending)
+
+    def submit(self, folder, lock, on_unique=None, attempts=CHECK_ATTEMPTS):
+        """
+            Checks the folder in a worker. The lock of the folder is
+            kept until the result comes, then the folder is either
+            removed as a duplicate or released for the master. If
+            on_unique is given, it is called instead of the release.
+            A failed check is tried again. After the last attempt or
+            the close, the folder is removed, so it is never shared
+            unchecked.
+        """
+        def _on_result(is_shared_before):
+            if is_shared_before:
+                logger.warning(
+                    "The image shared before, filtered on image: %s", folder
+                )
+                _remove_folder(folder)
+            elif on_unique is None:
+                lock.release()
+            else:
+                on_unique()
+            # Popped after the handling, so no result is lost for waiters
+            self._pending.pop(folder, None)
+
+        def _on_error(error):
+            if attempts > 1 and not self._is_closed:
+                logger.warning(
+                    "Duplicate check failed for %s, retrying: %s", folder, error
+                )
+                try:
+                    # Replaces the pending result of the folder
+                    self.submit(folder, lock, on_unique, attempts - 1)
+                    return
+                except ValueError as submit_error:
+                    # The pool is closed meanwhile
+                    error = submit_error
+            logger.error(
+                "Duplicate check failed for %s, removing: %s", folder, error
+            )
+            _remove_folder(folder)
+            self._pending.pop(folder, None)
+
+        self._pending[folder] = self._pool.apply_async(
+            is_any_photo_shared, (folder,),
+            callback=_on_result, error_callback=_on_error
+        )
+
+    def close(self):
+        "Waits the pending checks and stops the workers"
+        self._is_closed = True
+        self._pool.close()
+        self._pool.join()
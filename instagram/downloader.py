@@ -0,0 +1,195 @@
+"""
+Downloads the media files concurrently over a shared keep-alive
+session with a limited count of connections for each host.
+
+The files are written as .part and renamed only after they are
+checked, so no truncated media reaches the duplicate checker.
+"""
+import os
+import time
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import exceptions
+from common.logger import logger
+from instagram.base import MediaTypes
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30  # Seconds
+BACKOFF = 0.5  # Seconds, doubled on each retry
+PART_EXT = ".part"
+
+_JPEG_START = b"\xff\xd8\xff"
+_JPEG_END = b"\xff\xd9"
+
+DownloadTiming = namedtuple(
+    "DownloadTiming", ["url", "size", "seconds", "attempts"]
+)
+
+
+def is_complete_media(path, media_name, expected_size=None):
+    """
+        A cheap integrity check with the size and the magic bytes.
+        media_name decides the type since the path could be a .part
+    """
+    size = os.path.getsize(path)
+    if size == 0 or (expected_size is not None and size != expected_size):
+        return False
+
+    media_type = MediaTypes.get_media_type(media_name, ignore_error=True)
+    with open(path, "rb") as media_file:
+        head = media_file.read(12)
+        if media_type == MediaTypes.PHOTO:
+            media_file.seek(max(size - 32, 0))
+            # Some encoders put padding after the end marker
+            return head.startswith(_JPEG_START) and \
+                _JPEG_END in media_file.read()
+        if media_type == MediaTypes.VIDEO:
+            return head[4:8] == b"ftyp"
+    return True
+
+
+class IncompleteMedia(requests.RequestException):
+    "The downloaded file did not pass the integrity check"
+
+
+class MediaDownloader:
+    "A bounded pool of download threads sharing pooled connections"
+
+    def __init__(self, workers, per_host, proxies=None, retries=3):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="downloader"
+        )
+        self._per_host = per_host
+        self._host_limits = {}
+        self._lock = threading.Lock()
+        self.retries = retries
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        if proxies:
+            self._session.proxies.update(proxies)
+
+    def _get_host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self._per_host
+                )
+            return self._host_limits[host]
+
+    def _stream(self, url, part_filename):
+        """
+            Streams the response into the part file. If the file has
+            data from an interrupted attempt, only the rest is requested
+            with a Range header. Returns the size and the expected size.
+        """
+        offset = 0
+        headers = {}
+        if os.path.isfile(part_filename):
+            offset = os.path.getsize(part_filename)
+            headers["Range"] = f"bytes={offset}-"
+
+        response = self._session.get(
+            url, headers=headers, stream=True, timeout=TIMEOUT
+        )
+        try:
+            if response.status_code == 416:
+                # The part file is not valid for the range, start over
+                os.unlink(part_filename)
+                raise IncompleteMedia(url)
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The server ignored the range
+                offset = 0
+
+            expected_size = None
+            if "Content-Length" in response.headers:
+                expected_size = offset + int(response.headers["Content-Length"])
+
+            size = offset
+            with open(part_filename, "ab" if offset else "wb") as media_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    media_file.write(chunk)
+                    size += len(chunk)
+        finally:
+            # Gives the connection back to the pool
+            response.close()
+        return size, expected_size
+
+    def _download(self, url, filename):
+        "Downloads into a part file, checks and renames it atomically"
+        part_filename = filename + PART_EXT
+        size, expected_size = self._stream(url, part_filename)
+        if expected_size is not None and size < expected_size:
+            # Connection closed early, the next attempt resumes
+            raise IncompleteMedia(url)
+        if not is_complete_media(part_filename, filename, expected_size):
+            os.unlink(part_filename)
+            raise IncompleteMedia(url)
+
+        os.replace(part_filename, filename)
+        return size
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, IncompleteMedia):
+            return True
+        response = getattr(error, "response", None)
+        if response is None:
+            # Connection errors and timeouts
+            return True
+        return response.status_code == 429 or response.status_code >= 500
+
+    @staticmethod
+    def _remove_part(filename):
+        try:
+            os.unlink(filename + PART_EXT)
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, url, filename):
+        """
+            Downloads the url into the file, blocks until it is done.
+            Retries with an exponential backoff, returns the timing.
+        """
+        start_time = time.perf_counter()
+        with self._get_host_limit(url):
+            for attempt in range(1, self.retries + 1):
+                try:
+                    size = self._download(url, filename)
+                    break
+                except requests.RequestException as error:
+                    if attempt == self.retries or not self._is_retryable(error):
+                        self._remove_part(filename)
+                        raise exceptions.DownloadFailed(url, error)
+                    logger.warning(
+                        "Download failed, retrying(%d): %s", attempt, error
+                    )
+                    time.sleep(BACKOFF * 2 ** (attempt - 1))
+
+        timing = DownloadTiming(
+            url, size, time.perf_counter() - start_time, attempt
+        )
+        logger.debug(
+            "Downloaded %d bytes in %.3f seconds with %d attempt(s)",
+            timing.size, timing.seconds, timing.attempts
+        )
+        return timing
+
+    def submit(self, function, *args):
+        "Runs the function in a download thread, returns its future"
+        return self._executor.submit(function, *args)
+
+    def close(self):
+        "Waits the running downloads and stops the threads"
+        self._executor.shutdown(wait=True)
+        self._session.close()
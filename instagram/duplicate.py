@@ -1,37 +1,71 @@
 "Gives some tools for checking the image is shared before"
 import os
+import time
 import logging
+import tempfile
+import functools
 
-from cv2 import cv2
+import numpy
 
-from settings import SHARED
-from common.tools import logger
+from settings import SHARED, FINGERPRINT_INDEX
+from common.tools import logger, FileLock
+from instagram.base import MediaTypes
+from instagram.fingerprint import image_histogram, media_fingerprint, \
+    hamming_distances, Fingerprint, HISTOGRAM_SIZE, \
+    orb_descriptors, count_good_matches
 
 TRESHOLD = 0.3
 TRESHOLD_PERCANTAGE = 90
 
+# "histogram" compares the histograms against the whole archive,
+# "hash" looks up the dHashes within HAMMING_TRESHOLD bits of the archive,
+# "cascade" verifies the nearest hashes and the best histogram matches
+# with ORB features
+DUPLICATE_METHOD = "histogram"
+HAMMING_TRESHOLD = 10
+
+# Cascade settings, from each of the hash and the histogram prefilters
+CASCADE_CANDIDATES = 3
+CASCADE_PREFILTER_PERCANTAGE = 60
+CASCADE_HAMMING_LIMIT = 24
+ORB_MIN_GOOD_MATCHES = 25
+
+
+def normalize_histograms(histograms):
+    """
+        Centers and scales the histograms to unit length. The dot
+        product of two normalized histograms is their correlation,
+        the same value cv2.TM_CCOEFF_NORMED gives for them.
+    """
+    histograms = numpy.asarray(histograms, dtype=numpy.float32)
+    histograms = numpy.atleast_2d(histograms)
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    norms = numpy.linalg.norm(centered, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return centered / norms
+
+
+def _histogram_similarity(first_image_hist, second_image_hist):
+    "Returns the similarity of two histograms as percentage"
+    first, second = normalize_histograms(
+        [first_image_hist, second_image_hist]
+    )
+    return float(numpy.dot(first, second)) * 100
+
 
 def is_similar(image1, image2):
     "Compares two images"
     logger.debug(
         "First image: %s, Second image: %s", image1, image2
     )
-    image1 = cv2.imread(image1)
-    image2 = cv2.imread(image2)
-
-    first_image_hist = cv2.calcHist([image1], [0], None, [256], [0, 256])
-    second_image_hist = cv2.calcHist([image2], [0], None, [256], [0, 256])
-
-    # img_hist_diff = cv2.compareHist(
-    #     first_image_hist, second_image_hist,
-    #     cv2.HISTCMP_BHATTACHARYYA
-    # )
-    img_template_probability_match = cv2.matchTemplate(
-        first_image_hist, second_image_hist,
-        cv2.TM_CCOEFF_NORMED
-    )[0][0]
-
-    img_template_probability_match *= 100
+    first_image_hist = image_histogram(image1)
+    second_image_hist = image_histogram(image2)
+    if first_image_hist is None or second_image_hist is None:
+        return False
+
+    img_template_probability_match = _histogram_similarity(
+        first_image_hist, second_image_hist
+    )
     similar = bool(img_template_probability_match >= TRESHOLD_PERCANTAGE)
 
     log_level = logging.WARNING if similar else logging.INFO
@@ -45,23 +79,490 @@ def is_similar(image1, image2):
     return similar
 
 
-def is_shared(filepath):
-    "Checks the file to decide the image shared before or not"
-    for folder in os.listdir(SHARED):
-        folder = os.path.join(SHARED, folder)
-        logger.info("folders are: %s", folder)
+# Increase on any change of the fingerprints, the index is rebuilt
+INDEX_VERSION = 1
+
+
+class FingerprintIndex:
+    """
+        Keeps the fingerprints of the shared media on disk, so
+        the archive is decoded once instead of on every check.
+    """
+
+    def __init__(self, path=FINGERPRINT_INDEX, root=SHARED):
+        self.path = path
+        self.root = root
+        self._fingerprints = {}
+        self._mtime = None
+        self._matrices = {}
+        self._hash_arrays = {}
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def items(self):
+        "Returns the (name, fingerprint) pairs"
+        return self._fingerprints.items()
+
+    def _names(self, is_video):
+        return [name for name, fingerprint in self._fingerprints.items()
+                if fingerprint.is_video == is_video]
+
+    def matrix(self, is_video=False):
+        """
+            Returns the names and the normalized histogram matrix of
+            the photos, or of the videos if is_video is True
+        """
+        if is_video not in self._matrices:
+            names = self._names(is_video)
+            histograms = numpy.zeros((len(names), HISTOGRAM_SIZE))
+            if names:
+                histograms = normalize_histograms(
+                    [self._fingerprints[name].histogram for name in names]
+                )
+            self._matrices[is_video] = names, histograms
+        return self._matrices[is_video]
+
+    def hashes(self, is_video=False):
+        "Returns the names and the uint64 hash array of the photos or videos"
+        if is_video not in self._hash_arrays:
+            names = self._names(is_video)
+            hashes = numpy.array(
+                [self._fingerprints[name].hash for name in names],
+                dtype=numpy.uint64
+            )
+            self._hash_arrays[is_video] = names, hashes
+        return self._hash_arrays[is_video]
+
+    def _invalidate(self):
+        self._matrices = {}
+        self._hash_arrays = {}
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        "Loads the index from disk"
+        self._mtime = self._get_mtime()
+        self._fingerprints = {}
+        self._invalidate()
+        if self._mtime is None:
+            return
+
+        with numpy.load(self.path) as data:
+            if "version" not in data.files or \
+                    int(data["version"]) != INDEX_VERSION:
+                logger.warning("Fingerprint index is outdated, rebuilding")
+                return
+            for name, histogram, hash_, is_video in zip(
+                    data["names"], data["histograms"],
+                    data["hashes"], data["is_video"]):
+                self._fingerprints[str(name)] = Fingerprint(
+                    histogram, int(hash_), bool(is_video)
+                )
+        logger.debug("%d fingerprints loaded", len(self))
+
+    def refresh(self):
+        "Reloads the index if an other process has changed it"
+        if self._get_mtime() != self._mtime:
+            self.load()
+
+    def lock(self):
+        """
+            Returns the lock of the index file. The writers hold it from
+            the refresh to the save, so no entry of the others is lost.
+        """
+        return FileLock(self.path + ".lock")
+
+    def save(self):
+        """
+            Writes the index to the disk atomically, through a temporary
+            file of its own. The caller holds the lock.
+        """
+        names = list(self._fingerprints)
+        histograms = numpy.array(
+            [self._fingerprints[name].histogram for name in names],
+            dtype=numpy.float32
+        ).reshape(len(names), HISTOGRAM_SIZE)
+        hashes = numpy.array(
+            [self._fingerprints[name].hash for name in names],
+            dtype=numpy.uint64
+        )
+        is_video = numpy.array(
+            [self._fingerprints[name].is_video for name in names],
+            dtype=bool
+        )
+
+        file_descriptor, temp_path = tempfile.mkstemp(
+            prefix=".fingerprints_", suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(self.path))
+        )
+        try:
+            with os.fdopen(file_descriptor, "wb") as index_file:
+                numpy.savez(
+                    index_file,
+                    names=numpy.array(names, dtype=str),
+                    histograms=histograms,
+                    hashes=hashes,
+                    is_video=is_video,
+                    version=numpy.array(INDEX_VERSION)
+                )
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._mtime = self._get_mtime()
+
+    def _add_file(self, filepath):
+        name = os.path.relpath(filepath, self.root)
+        if name in self._fingerprints:
+            return False
+
+        fingerprint = media_fingerprint(filepath)
+        if fingerprint is None:
+            logger.warning("Could not fingerprint %s", filepath)
+            return False
+
+        self._fingerprints[name] = fingerprint
+        self._invalidate()
+        return True
+
+    def _add_files(self, folder):
+        is_changed = False
         for filename in os.listdir(folder):
-            filename = os.path.join(folder, filename)
-            if is_similar(filepath, filename):
-                return True
+            if not MediaTypes.is_known_extension(filename):
+                continue
+            is_changed |= self._add_file(os.path.join(folder, filename))
+        return is_changed
+
+    def add_folder(self, folder):
+        "Adds the media in the given shared folder to the index"
+        with self.lock():
+            self.refresh()
+            is_changed = self._add_files(folder)
+            if is_changed:
+                self.save()
+        return is_changed
+
+    def sync(self):
+        "Makes the index consistent with the files under the shared folder"
+        with self.lock():
+            self._sync()
+
+    def _sync(self):
+        self.refresh()
+        os.makedirs(self.root, exist_ok=True)
+
+        existing = set()
+        is_changed = False
+        for folder in os.listdir(self.root):
+            folder = os.path.join(self.root, folder)
+            if not os.path.isdir(folder):
+                continue
+            is_changed |= self._add_files(folder)
+            existing.update(
+                os.path.relpath(os.path.join(folder, filename), self.root)
+                for filename in os.listdir(folder)
+            )
+
+        for name in set(self._fingerprints) - existing:
+            del self._fingerprints[name]
+            self._invalidate()
+            is_changed = True
+
+        if is_changed:
+            logger.info("Fingerprint index synced, %d entries", len(self))
+            self.save()
+
+
+_INDEX = None
+
+
+def get_index():
+    "Returns the fingerprint index of the process, creates on first use"
+    # pylint: disable=global-statement
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = FingerprintIndex()
+        _INDEX.sync()
+    else:
+        _INDEX.refresh()
+    return _INDEX
+
+
+def _read_fingerprints(filepaths):
+    "Returns the photo and the video fingerprints of the readable files"
+    fingerprints = {False: [], True: []}
+    for filepath in filepaths:
+        fingerprint = media_fingerprint(filepath)
+        if fingerprint is None:
+            logger.warning("Could not read %s", filepath)
+            continue
+        fingerprints[fingerprint.is_video].append((filepath, fingerprint))
+    return fingerprints
+
+
+def use_index(index):
+    "Replaces the index of the process, e.g. with one of an other archive"
+    # pylint: disable=global-statement
+    global _INDEX
+    _INDEX = index
+
+
+def _similarities(filepaths):
+    """
+        Yields the readable files, the archive names and the similarity
+        matrix of them computed with one product. Photos and videos are
+        compared only with their own kind, so they come separately.
+    """
+    for is_video, fingerprints in _read_fingerprints(filepaths).items():
+        if not fingerprints:
+            continue
+        readable = [filepath for filepath, _ in fingerprints]
+        names, shared_histograms = get_index().matrix(is_video)
+        if not names:
+            yield readable, names, None
+            continue
+
+        similarities = normalize_histograms(
+            [fingerprint.histogram for _, fingerprint in fingerprints]
+        ) @ shared_histograms.T
+        yield readable, names, similarities * 100
+
+
+def best_matches(filepaths):
+    """
+        Compares the given files with the whole archive at once.
+        Returns (filepath, shared name, similarity percentage) for
+        each readable file, shared name is None for empty archive.
+    """
+    matches = []
+    for readable, names, similarities in _similarities(filepaths):
+        if similarities is None:
+            matches.extend((filepath, None, 0.0) for filepath in readable)
+            continue
+
+        best_indexes = similarities.argmax(axis=1)
+        matches.extend(
+            (filepath, names[best], float(similarities[row, best]))
+            for row, (filepath, best) in enumerate(zip(readable, best_indexes))
+        )
+    return matches
+
+
+def nearest_hashes(filepaths, max_distance=HAMMING_TRESHOLD):
+    """
+        Compares the dHash of the given files with every archived hash
+        in one vectorized XOR and bit count. Returns (filepath, shared
+        name, distance) for each file that has an archived image within
+        max_distance bits.
+    """
+    matches = []
+    for is_video, fingerprints in _read_fingerprints(filepaths).items():
+        names, hashes = get_index().hashes(is_video)
+        if not names:
+            continue
+        for filepath, fingerprint in fingerprints:
+            distances = hamming_distances(fingerprint.hash, hashes)
+            nearest = int(numpy.argmin(distances))
+            if distances[nearest] <= max_distance:
+                matches.append(
+                    (filepath, names[nearest], int(distances[nearest]))
+                )
+    return matches
+
+
+class CascadeStats:
+    "Keeps the timings and the hit rates of the cascade stages"
+
+    def __init__(self):
+        self.checked_files = 0
+        self.prefilter_time = 0.0
+        self.prefilter_hits = 0
+        self.candidates = 0
+        self.verify_time = 0.0
+        self.verified = 0
+
+    @property
+    def prefilter_hit_rate(self):
+        "Ratio of the files which has at least one candidate"
+        return self.prefilter_hits / max(self.checked_files, 1)
+
+    @property
+    def verify_hit_rate(self):
+        "Ratio of the candidates which are verified as duplicate"
+        return self.verified / max(self.candidates, 1)
+
+    def log(self):
+        "Logs the statistics"
+        logger.info(
+            "Cascade stats: %d files, prefilter %.3fs hit rate %.2f, "
+            "%d candidates, verify %.3fs hit rate %.2f",
+            self.checked_files,
+            self.prefilter_time, self.prefilter_hit_rate,
+            self.candidates,
+            self.verify_time, self.verify_hit_rate
+        )
+
+
+CASCADE_STATS = CascadeStats()
+
+
+@functools.lru_cache(maxsize=256)
+def _shared_descriptors(root, name):
+    return orb_descriptors(os.path.join(root, name))
+
+
+def _hash_candidates(fingerprints, is_video):
+    "Yields the CASCADE_CANDIDATES nearest hashes of each file"
+    names, hashes = get_index().hashes(is_video)
+    count = min(CASCADE_CANDIDATES, len(names))
+    for filepath, fingerprint in fingerprints:
+        distances = hamming_distances(fingerprint.hash, hashes)
+        nearest = numpy.argsort(distances, kind="stable")[:count]
+        yield filepath, [
+            names[index] for index in nearest
+            if distances[index] <= CASCADE_HAMMING_LIMIT
+        ]
+
+
+def _histogram_candidates(fingerprints, is_video):
+    "Yields the CASCADE_CANDIDATES best histogram matches of each file"
+    names, shared_histograms = get_index().matrix(is_video)
+    similarities = normalize_histograms(
+        [fingerprint.histogram for _, fingerprint in fingerprints]
+    ) @ shared_histograms.T * 100
+    count = min(CASCADE_CANDIDATES, len(names))
+    top_indexes = numpy.argsort(-similarities, axis=1)[:, :count]
+    for row, (filepath, _) in enumerate(fingerprints):
+        yield filepath, [
+            names[index] for index in top_indexes[row]
+            if similarities[row, index] >= CASCADE_PREFILTER_PERCANTAGE
+        ]
+
+
+def _cascade_candidates(filepaths, stats):
+    """
+        Returns the union of the nearest hashes and the best histogram
+        matches of each file. The dHash survives a brightness shift,
+        which moves the whole histogram.
+    """
+    start_time = time.perf_counter()
+    candidates = {}
+    for is_video, fingerprints in _read_fingerprints(filepaths).items():
+        stats.checked_files += len(fingerprints)
+        if not fingerprints or not get_index().hashes(is_video)[0]:
+            continue
+
+        for prefilter in (_hash_candidates, _histogram_candidates):
+            for filepath, names in prefilter(fingerprints, is_video):
+                file_candidates = candidates.setdefault(filepath, [])
+                file_candidates.extend(
+                    name for name in names if name not in file_candidates
+                )
+
+    stats.prefilter_hits += sum(1 for names_ in candidates.values() if names_)
+    stats.candidates += sum(len(names_) for names_ in candidates.values())
+    stats.prefilter_time += time.perf_counter() - start_time
+    return candidates
+
+
+def _verify_candidates(candidates, stats):
+    "Returns the first candidate of each file verified with ORB features"
+    start_time = time.perf_counter()
+    root = get_index().root
+    matches = []
+    for filepath, shared_names in candidates.items():
+        if not shared_names:
+            continue
+        descriptors = orb_descriptors(filepath)
+        for name in shared_names:
+            good_matches = count_good_matches(
+                descriptors, _shared_descriptors(root, name)
+            )
+            logger.debug(
+                "%s has %d good matches with %s",
+                filepath, good_matches, name
+            )
+            if good_matches >= ORB_MIN_GOOD_MATCHES:
+                stats.verified += 1
+                matches.append((filepath, name, good_matches))
+                break
+    stats.verify_time += time.perf_counter() - start_time
+    return matches
+
+
+def cascade_matches(filepaths, stats=CASCADE_STATS):
+    """
+        Keeps the nearest hashes and the best histogram matches of each
+        file, then verifies only them with ORB keypoints and a FLANN matcher.
+        Returns (filepath, shared name, good match count) for each file
+        verified as duplicate.
+    """
+    matches = _verify_candidates(_cascade_candidates(filepaths, stats), stats)
+    stats.log()
+    return matches
+
+
+def _is_any_cascade_match(matches):
+    for filepath, name, good_matches in matches:
+        logger.warning(
+            "%s is similar to %s, good feature matches: %d",
+            filepath, name, good_matches
+        )
+        return True
+    return False
+
+
+def _is_any_hash_match(matches):
+    for filepath, name, distance in matches:
+        logger.warning(
+            "%s is similar to %s, hamming distance: %d",
+            filepath, name, distance
+        )
+        return True
     return False
 
 
+def _is_any_match(matches):
+    for filepath, name, similarity in matches:
+        logger.debug(
+            "Best match of %s is %s, similarity: %s",
+            filepath, name, similarity
+        )
+        if similarity >= TRESHOLD_PERCANTAGE:
+            logger.warning(
+                "%s is similar to %s, similarity: %s",
+                filepath, name, similarity
+            )
+            return True
+    return False
+
+
+def _is_any_shared(filepaths):
+    if DUPLICATE_METHOD == "hash":
+        return _is_any_hash_match(nearest_hashes(filepaths))
+    if DUPLICATE_METHOD == "cascade":
+        return _is_any_cascade_match(cascade_matches(filepaths))
+    return _is_any_match(best_matches(filepaths))
+
+
+def is_shared(filepath):
+    "Checks the file to decide the image shared before or not"
+    return _is_any_shared([filepath])
+
+
 def is_any_photo_shared(folder):
     "Checks the files in the folder to decide the image shared before or not"
     logger.info("Checking for is any photo shared before")
-    for filename in os.listdir(folder):
-        logger.debug("Filename is: %s", filename)
-        if is_shared(os.path.join(folder, filename)):
-            return True
-    return False
+    filepaths = [
+        os.path.join(folder, filename) for filename in os.listdir(folder)
+        if MediaTypes.is_known_extension(filename)
+    ]
+    return _is_any_shared(filepaths)
@@ -0,0 +1,112 @@
+"""
+Rolling engagement statistics of the users. They are updated
+from the posts the slave already fetches, so the baselines
+need no extra requests.
+"""
+import math
+
+import settings
+from instagram_database.db import UserStats
+
+
+def _mean_and_variance(values):
+    if not values:
+        return 0.0, 0.0
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / len(values)
+    return mean, variance
+
+
+def _ewma(mean, variance, value, alpha):
+    "Returns the exponentially weighted mean and variance with the value"
+    difference = value - mean
+    increment = alpha * difference
+    return mean + increment, (1 - alpha) * (variance + difference * increment)
+
+
+class EngagementStats:
+    "Exponentially weighted mean and variance of likes and comments"
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, user_id,
+                 like_mean=0.0, like_variance=0.0,
+                 comment_mean=0.0, comment_variance=0.0,
+                 samples=0, last_taken_at=0):
+        self.user_id = user_id
+        self.like_mean = like_mean
+        self.like_variance = like_variance
+        self.comment_mean = comment_mean
+        self.comment_variance = comment_variance
+        self.samples = samples
+        self.last_taken_at = last_taken_at
+
+    @classmethod
+    def from_record(cls, record):
+        "Creates the statistics from the database record"
+        return cls(
+            record.id,
+            float(record.like_mean), float(record.like_variance),
+            float(record.comment_mean), float(record.comment_variance),
+            int(record.samples), int(record.last_taken_at)
+        )
+
+    def to_record(self):
+        "Returns the database record of the statistics"
+        return UserStats(
+            self.user_id,
+            self.like_mean, self.like_variance,
+            self.comment_mean, self.comment_variance,
+            self.samples, self.last_taken_at
+        )
+
+    @classmethod
+    def from_feed(cls, user_id, items):
+        "Creates the statistics from the items of a user feed"
+        like_mean, like_variance = _mean_and_variance(
+            [item["like_count"] for item in items]
+        )
+        # The items with disabled comments have no comment count
+        comment_mean, comment_variance = _mean_and_variance(
+            [item["comment_count"] for item in items if "comment_count" in item]
+        )
+        return cls(
+            user_id,
+            like_mean, like_variance,
+            comment_mean, comment_variance,
+            len(items),
+            max((item["taken_at"] for item in items), default=0)
+        )
+
+    def update(self, item):
+        """
+            Adds the item into the statistics once.
+            Returns False if the item is added before.
+        """
+        if item["taken_at"] <= self.last_taken_at:
+            return False
+
+        alpha = settings.ENGAGEMENT_EWMA_ALPHA
+        self.like_mean, self.like_variance = _ewma(
+            self.like_mean, self.like_variance, item["like_count"], alpha
+        )
+        if "comment_count" in item:
+            self.comment_mean, self.comment_variance = _ewma(
+                self.comment_mean, self.comment_variance,
+                item["comment_count"], alpha
+            )
+        self.samples += 1
+        self.last_taken_at = item["taken_at"]
+        return True
+
+    def like_threshold(self, std_factor=0.0):
+        """
+            Returns mean + std_factor * standard deviation of the likes.
+            With a normal distribution 0 is the 50th percentile,
+            1 is about the 84th one.
+        """
+        return self.like_mean + std_factor * math.sqrt(self.like_variance)
+
+    def comment_threshold(self, std_factor=0.0):
+        "Returns mean + std_factor * standard deviation of the comments"
+        return self.comment_mean + \
+            std_factor * math.sqrt(self.comment_variance)
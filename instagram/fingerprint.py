@@ -0,0 +1,199 @@
+"Computes the fingerprints that the duplicate checker compares"
+from collections import namedtuple
+
+import numpy
+from cv2 import cv2
+
+from instagram.base import MediaTypes
+
+HISTOGRAM_SIZE = 256
+HASH_SIZE = 8
+ORB_FEATURES = 500
+VIDEO_KEYFRAMES = 5
+_FLANN_INDEX_LSH = 6
+
+# Images are decoded at 1/REDUCTION of their size, JPEG decoder
+# scales the DCT blocks down instead of decoding the full image.
+FINGERPRINT_REDUCTION = 4
+ORB_REDUCTION = 2
+_REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+Fingerprint = namedtuple("Fingerprint", ["histogram", "hash", "is_video"])
+
+
+def _is_video(path):
+    return MediaTypes.get_media_type(
+        path, ignore_error=True
+    ) == MediaTypes.VIDEO
+
+
+def _reduce_frame(frame, reduction):
+    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if reduction == 1:
+        return frame
+    height, width = frame.shape
+    return cv2.resize(
+        frame, (max(width // reduction, 1), max(height // reduction, 1)),
+        interpolation=cv2.INTER_AREA
+    )
+
+
+def _read_keyframes(path, count=VIDEO_KEYFRAMES, reduction=FINGERPRINT_REDUCTION):
+    """
+        Seeks to evenly spaced frames of the video and reads only them
+        as small grayscale arrays. The first and the last frames are
+        skipped since they are usually black or a fade.
+    """
+    capture = cv2.VideoCapture(path)
+    frames = []
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        for index in range(count if frame_count > 0 else 0):
+            position = frame_count * (index + 1) // (count + 1)
+            capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+            is_read, frame = capture.read()
+            if is_read:
+                frames.append(_reduce_frame(frame, reduction))
+    finally:
+        capture.release()
+    return frames
+
+
+def load_gray(path, reduction=FINGERPRINT_REDUCTION):
+    """
+        Returns the image as a small grayscale array, the middle keyframe
+        for the videos. None if it could not be read. Every comparison
+        gets its pixels from here.
+    """
+    if _is_video(path):
+        frames = _read_keyframes(path, count=1, reduction=reduction)
+        return frames[0] if frames else None
+    return cv2.imread(path, _REDUCED_GRAYSCALE_FLAGS[reduction])
+
+
+def _histogram(image):
+    return cv2.calcHist(
+        [image], [0], None, [HISTOGRAM_SIZE], [0, 256]
+    ).ravel()
+
+
+def _hash_thumbnail(image):
+    return cv2.resize(
+        image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA
+    ).astype(numpy.float32)
+
+
+def _difference_hash(image=None, thumbnail=None):
+    "Returns the 64 bit dHash of the image or of its hash thumbnail"
+    if thumbnail is None:
+        thumbnail = _hash_thumbnail(image)
+    difference = thumbnail[:, 1:] > thumbnail[:, :-1]
+
+    value = 0
+    for bit in difference.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(first_hash, second_hash):
+    "Returns the count of different bits of two hashes"
+    return bin(first_hash ^ second_hash).count("1")
+
+
+_BIT_COUNTS = numpy.array(
+    [bin(byte).count("1") for byte in range(256)], dtype=numpy.uint8
+)
+
+
+def hamming_distances(query_hash, hashes):
+    """
+        Returns the count of different bits of the hash and each of
+        the hashes, an uint64 array, in one vectorized pass
+    """
+    differences = numpy.bitwise_xor(
+        numpy.asarray(hashes, dtype=numpy.uint64), numpy.uint64(query_hash)
+    )
+    # Counts the bits byte by byte with a lookup table
+    return _BIT_COUNTS[differences.view(numpy.uint8)].reshape(
+        len(differences), 8
+    ).sum(axis=1)
+
+
+def image_histogram(path):
+    "Returns the histogram of the image, None if it could not be read"
+    image = load_gray(path)
+    if image is None:
+        return None
+    return _histogram(image)
+
+
+def image_fingerprint(path):
+    "Returns the whole fingerprint of the image with a single decode"
+    image = load_gray(path)
+    if image is None:
+        return None
+    return Fingerprint(_histogram(image), _difference_hash(image), False)
+
+
+def video_fingerprint(path):
+    """
+        Returns the fingerprint of the video from a few keyframes,
+        None if no frame could be read. The histogram is the sum of
+        the keyframe histograms, the hash is of their mean thumbnail.
+    """
+    frames = _read_keyframes(path)
+    if not frames:
+        return None
+
+    histogram = sum(_histogram(frame) for frame in frames)
+    thumbnail = numpy.mean([_hash_thumbnail(frame) for frame in frames], axis=0)
+    return Fingerprint(
+        histogram, _difference_hash(thumbnail=thumbnail), True
+    )
+
+
+def media_fingerprint(path):
+    "Returns the fingerprint of the photo or the video"
+    if _is_video(path):
+        return video_fingerprint(path)
+    return image_fingerprint(path)
+
+
+def orb_descriptors(path, features=ORB_FEATURES):
+    "Returns the ORB descriptors of the image, None if there is none"
+    image = load_gray(path, reduction=ORB_REDUCTION)
+    if image is None:
+        return None
+
+    orb = cv2.ORB_create(nfeatures=features)
+    _, descriptors = orb.detectAndCompute(image, None)
+    return descriptors
+
+
+def count_good_matches(first_descriptors, second_descriptors, ratio=0.75):
+    "Matches ORB descriptors with FLANN, returns the count passes ratio test"
+    if first_descriptors is None or second_descriptors is None:
+        return 0
+    if len(first_descriptors) < 2 or len(second_descriptors) < 2:
+        return 0
+
+    matcher = cv2.FlannBasedMatcher(
+        {
+            "algorithm": _FLANN_INDEX_LSH,
+            "table_number": 6,
+            "key_size": 12,
+            "multi_probe_level": 1,
+        },
+        {"checks": 50}
+    )
+    good_matches = 0
+    for pair in matcher.knnMatch(first_descriptors, second_descriptors, k=2):
+        # LSH may return less than k neighbours
+        if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance:
+            good_matches += 1
+    return good_matches
@@ -2,17 +2,31 @@
 A instagram user for posting medias.
 """
 import os
+import time
 import shutil
 
 import settings
 from instagram.base import BaseInstagram, MediaTypes
+from instagram.duplicate import get_index
+from instagram.upload_queue import UploadQueue, DONE
 from common.tools import LockDir
+from common.watcher import watch_lock_releases
 from common.logger import logger
+from instagram_database.db import DB, get_realtime_setting
+
+DOWNLOADS_PREFIX = "downloaded_images_"
 
 
 class MasterInstagram(BaseInstagram):
     "Master instagram user"
 
+    def __init__(self, username, password, queue=None, **kwargs):
+        super().__init__(username, password, queue, **kwargs)
+        self._uploads = UploadQueue(
+            DB(), settings.UPLOAD_ATTEMPTS, settings.UPLOAD_BACKOFF_S,
+            settings.TRANSCODE_WAIT_S, settings.TRANSCODE_DEADLINE_S
+        )
+
     def _start(self):
         # threading.Thread(target=self._start_cleaner).start()
         self._start_sharing()
@@ -21,50 +35,140 @@ class MasterInstagram(BaseInstagram):
         pass
 
     def _start_sharing(self):
+        """
+            Queues the unlocked folders whenever a lock is released,
+            checks the downloads folder every LISTENER_WAIT_TIME anyway.
+            The queued uploads are drained between the checks.
+        """
         os.makedirs(settings.DOWNLOADS, exist_ok=True)
         os.makedirs(settings.SHARED, exist_ok=True)
+        for job in self._uploads.recover():
+            # The lock of the interrupted upload is left in the folder
+            LockDir(job.folder).release()
         logger.info("Listening the downloads folder")
-        while self.is_active:
-            logger.debug("Checking downloads folder")
-            for downloads in os.listdir(settings.DOWNLOADS):
-                downloads = os.path.join(settings.DOWNLOADS, downloads)
-                self.share_from_folder(downloads)
-            logger.debug("Downloads folder check is done.")
-
-            self._wait_with_log("LISTENER_WAIT_TIME")
+        with watch_lock_releases(settings.DOWNLOADS) as watcher:
+            is_released = True
+            check_time = 0
+            while self.is_active:
+                if is_released or time.monotonic() >= check_time:
+                    self._queue_unlocked_folders()
+                    check_time = time.monotonic() + get_realtime_setting(
+                        "LISTENER_WAIT_TIME", int
+                    )
+                self._drain_uploads()
+                # Wakes up for is_active at least every WAIT_SECS
+                is_released = watcher.wait(
+                    get_realtime_setting("WAIT_SECS", int, 10)
+                )
+
+    def _queue_unlocked_folders(self):
+        logger.debug("Checking downloads folder")
+        for downloads in os.listdir(settings.DOWNLOADS):
+            try:
+                media_id = int(downloads[len(DOWNLOADS_PREFIX):])
+            except ValueError:
+                logger.warning("Unknown folder in downloads: %s", downloads)
+                continue
+
+            downloads = os.path.join(settings.DOWNLOADS, downloads)
+            if LockDir(downloads).is_locked:
+                continue
+            job = self._uploads.enqueue(media_id, downloads)
+            if job.state == DONE:
+                # Shared before, the master stopped before moving it
+                self.move_to_shared(downloads)
+        logger.debug("Downloads folder check is done.")
+
+    def _drain_uploads(self):
+        """
+            Shares the due jobs one by one. The uploads share the
+            session and its headers, so they are never run in parallel.
+        """
+        while self.is_active and self._uploads.has_due_jobs():
+            self._configure_transcoded_videos()
+
+            for job in self._uploads.claim(1):
+                # pylint: disable=broad-except
+                try:
+                    is_shared, transcoded_video = \
+                        self.share_from_folder(job.folder)
+                    reason = "the post is not created"
+                except Exception as error:
+                    is_shared, transcoded_video, reason = False, None, error
+
+                if is_shared:
+                    self._uploads.succeed(job)
+                    self.move_to_shared(job.folder)
+                elif transcoded_video is not None:
+                    self._uploads.transcode(job, *transcoded_video)
+                else:
+                    self._uploads.fail(job, reason)
+
+    def _configure_transcoded_videos(self):
+        "Tries to configure the due videos once, the others wait longer"
+        for job, transcode in self._uploads.claim_transcodes():
+            # pylint: disable=broad-except
+            try:
+                is_configured = self.configure_video(
+                    transcode.upload_id, transcode.video
+                )
+            except Exception as error:
+                logger.warning("Video could not be configured: %s", error)
+                is_configured = False
+
+            if is_configured:
+                self.expose()
+                self._uploads.succeed(job)
+                self.move_to_shared(job.folder)
+            else:
+                self._uploads.retry_transcode(job, transcode)
 
     def share_from_folder(self, downloads):
-        "Shares file in the given folder"
-        os.chdir(downloads)
-        logger.info("New folder %s found.", downloads)
+        "Shares the files in the given folder, returns as the share"
+        logger.info("Sharing the folder %s", downloads)
         with LockDir(downloads, wait_until_release=True):
-            to_shared = [file for file in os.listdir(".")
+            # No chdir, the working directory is shared by the threads
+            to_shared = [os.path.join(downloads, file)
+                         for file in os.listdir(downloads)
                          if MediaTypes.is_known_extension(file)]
 
-            self.share(to_shared)
+            return self.share(to_shared)
 
-        os.chdir(settings.BASE_DIR)
-        self.move_to_shared(downloads)
+    def _is_last_request_ok(self):
+        return (self.LastJson or {}).get("status") == "ok"
 
     def share(self, share_list):
-        "Shares the given files"
+        """
+            Shares the given files. Returns (is_shared, transcoded_video),
+            transcoded_video is the (upload_id, video) of a single video
+            to configure after its transcode, None for the others.
+            The uploads of the api return no result, so the status of
+            the last response of the thread decides.
+        """
+        # Clears the response of an older request
+        self.LastJson = None
         if len(share_list) == 1:
-            self._share_single(share_list[0])
-        elif share_list:
+            return self._share_single(share_list[0])
+        if share_list:
             self._share_carousel(share_list)
-        else:
-            # Empty folder
-            return
+            return self._is_last_request_ok(), None
+        # Empty folder
+        return True, None
 
     def _share_single(self, filename):
         media_type = MediaTypes.get_media_type(filename, ignore_error=True)
 
         if media_type == MediaTypes.PHOTO:
             self.uploadPhoto(filename)
-        elif media_type == MediaTypes.VIDEO:
-            self.upload_video(filename, settings.DEFAULT_THUMBNAIL)
-        else:
-            logger.error("Unkown media type: %s", filename)
+            return self._is_last_request_ok(), None
+        if media_type == MediaTypes.VIDEO:
+            upload_id = self.send_video(filename, settings.DEFAULT_THUMBNAIL)
+            if upload_id is None:
+                return False, None
+            return False, (upload_id, filename)
+
+        logger.error("Unkown media type: %s", filename)
+        return False, None
 
     def _share_carousel(self, carousel_media):
         album = []
@@ -85,4 +189,13 @@ class MasterInstagram(BaseInstagram):
         "Moves the downloaded file under shared folder and renames"
         basename = os.path.basename(path)
         basename = basename.replace("downloaded", "shared")
-        shutil.move(path, os.path.join(settings.SHARED, basename))
+        destination = os.path.join(settings.SHARED, basename)
+        shutil.move(path, destination)
+        # pylint: disable=broad-except
+        try:
+            get_index().add_folder(destination)
+        except Exception as error:
+            # Shared already, the next sync adds it to the index
+            logger.error(
+                "%s could not be added to the index: %s", destination, error
+            )
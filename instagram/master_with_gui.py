@@ -13,9 +13,12 @@ from selenium.webdriver.chrome.options import Options
 
 import settings
 from common.tools import LockDir
+from common.watcher import watch_lock_releases
 from common.logger import logger
 from common.exceptions import LoginFail
 from instagram.base import BaseInstagram, MediaTypes
+from instagram.duplicate import get_index
+from instagram_database.db import get_realtime_setting
 
 URL = "https://www.instagram.com/accounts/login/?source=auth_switcher"
 
@@ -138,17 +141,34 @@ class MasterInstagram(BaseInstagram):
         return None
 
     def _start_sharing(self):
+        """
+            Shares the unlocked folders whenever a lock is released,
+            checks the downloads folder every LISTENER_WAIT_TIME anyway.
+        """
         os.makedirs(settings.DOWNLOADS, exist_ok=True)
         os.makedirs(settings.SHARED, exist_ok=True)
         logger.info("Listening the downloads folder")
-        while self.is_active:
-            logger.debug("Checking downloads folder")
-            for downloads in os.listdir(settings.DOWNLOADS):
-                downloads = os.path.join(settings.DOWNLOADS, downloads)
+        with watch_lock_releases(settings.DOWNLOADS) as watcher:
+            is_released = True
+            check_time = 0
+            while self.is_active:
+                if is_released or time.monotonic() >= check_time:
+                    self._share_unlocked_folders()
+                    check_time = time.monotonic() + get_realtime_setting(
+                        "LISTENER_WAIT_TIME", int
+                    )
+                # Wakes up for is_active at least every WAIT_SECS
+                is_released = watcher.wait(
+                    get_realtime_setting("WAIT_SECS", int, 10)
+                )
+
+    def _share_unlocked_folders(self):
+        logger.debug("Checking downloads folder")
+        for downloads in os.listdir(settings.DOWNLOADS):
+            downloads = os.path.join(settings.DOWNLOADS, downloads)
+            if not LockDir(downloads).is_locked:
                 self.share_from_folder(downloads)
-            logger.debug("Downloads folder check is done.")
-
-            self._wait_with_log("LISTENER_WAIT_TIME")
+        logger.debug("Downloads folder check is done.")
 
     def share_from_folder(self, downloads):
         "Shares file in the given folder"
@@ -226,4 +246,13 @@ class MasterInstagram(BaseInstagram):
         "Moves the downloaded file under shared folder and renames"
         basename = os.path.basename(path)
         basename = basename.replace("downloaded", "shared")
-        shutil.move(path, os.path.join(settings.SHARED, basename))
+        destination = os.path.join(settings.SHARED, basename)
+        shutil.move(path, destination)
+        # pylint: disable=broad-except
+        try:
+            get_index().add_folder(destination)
+        except Exception as error:
+            # Shared already, the next sync adds it to the index
+            logger.error(
+                "%s could not be added to the index: %s", destination, error
+            )
@@ -0,0 +1,47 @@
+"""
+Ranks the candidate posts of all the polled users together,
+only the best ones are downloaded.
+"""
+import heapq
+import itertools
+
+COMMENT_WEIGHT = 2  # A comment is worth this many likes
+AGE_GRAVITY = 1.8  # How fast the older posts sink
+AGE_OFFSET_HOURS = 2
+
+
+def score_post(item, follower_count, now):
+    """
+        Returns the engagement of the post per follower, decayed by
+        its age so an old post needs more engagement than a new one.
+    """
+    engagement = item["like_count"] + \
+        COMMENT_WEIGHT * item.get("comment_count", 0)
+    age_hours = max(now - item["taken_at"], 0) / 3600
+    return engagement / max(follower_count, 1) / \
+        (age_hours + AGE_OFFSET_HOURS) ** AGE_GRAVITY
+
+
+class PostRanker:
+    "Keeps the best count posts in a bounded min heap"
+
+    def __init__(self, count):
+        self.count = count
+        self._heap = []
+        # Breaks the ties, so the posts are never compared
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, score, post):
+        "Adds the post if it is one of the best count posts so far"
+        entry = (score, next(self._order), post)
+        if len(self._heap) < self.count:
+            heapq.heappush(self._heap, entry)
+        elif score > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def ranked(self):
+        "Returns the posts, the best first"
+        return [post for _, _, post in sorted(self._heap, reverse=True)]
@@ -0,0 +1,108 @@
+"""
+Decides when each followed user is polled. The posting rate of a
+user is learned from the times of its posts, the users posting
+often are polled often and the quiet ones rarely.
+"""
+import heapq
+
+GAP_EWMA_ALPHA = 0.3
+# Polls twice in the expected time between two posts
+POLL_GAP_FACTOR = 0.5
+
+
+class PollScheduler:
+    "A priority queue of the users ordered by their next due times"
+
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Entries are (due_time, user_id), the rescheduled ones stay
+        # in the heap and are skipped when they come to the top
+        self._heap = []
+        self._due_times = {}
+        self._last_poll_times = {}
+        self._last_post_times = {}
+        self._mean_gaps = {}
+
+    def _push(self, user_id, due_time):
+        self._due_times[user_id] = due_time
+        heapq.heappush(self._heap, (due_time, user_id))
+
+    def _is_stale(self, entry):
+        due_time, user_id = entry
+        return self._due_times.get(user_id) != due_time
+
+    def sync(self, user_ids, now):
+        "Adds the new users as due now, forgets the removed ones"
+        user_ids = set(user_ids)
+        for user_id in user_ids:
+            if user_id not in self._due_times:
+                self._push(user_id, now)
+
+        for user_id in set(self._due_times) - user_ids:
+            del self._due_times[user_id]
+            self._last_poll_times.pop(user_id, None)
+            self._last_post_times.pop(user_id, None)
+            self._mean_gaps.pop(user_id, None)
+
+    def pop_due(self, now):
+        "Removes and returns the users due until now, the earliest first"
+        due_users = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_stale(entry):
+                continue
+            del self._due_times[entry[1]]
+            due_users.append(entry[1])
+        return due_users
+
+    def next_due_time(self):
+        "Returns the earliest due time, None if there is no user"
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def lookback(self, user_id, now, default):
+        "Returns the seconds since the last poll of the user"
+        last_poll_time = self._last_poll_times.get(user_id)
+        if last_poll_time is None:
+            return default
+        return now - last_poll_time
+
+    def observe(self, user_id, post_times):
+        "Learns the posting rate of the user from the post times"
+        last_post_time = self._last_post_times.get(user_id)
+        for post_time in sorted(post_times):
+            if last_post_time is not None:
+                if post_time <= last_post_time:
+                    # Seen in an earlier poll
+                    continue
+                gap = post_time - last_post_time
+                mean_gap = self._mean_gaps.get(user_id, gap)
+                self._mean_gaps[user_id] = \
+                    mean_gap + GAP_EWMA_ALPHA * (gap - mean_gap)
+            last_post_time = post_time
+
+        if last_post_time is not None:
+            self._last_post_times[user_id] = last_post_time
+
+    def interval(self, user_id, now, default):
+        """
+            Returns the seconds until the next poll of the user, the
+            default one until its posting rate is known.
+        """
+        mean_gap = self._mean_gaps.get(user_id)
+        if mean_gap is None:
+            return default
+
+        # The silence of a quiet user stretches the expected gap
+        expected_gap = max(mean_gap, now - self._last_post_times[user_id])
+        return min(
+            max(expected_gap * POLL_GAP_FACTOR, self.min_interval),
+            self.max_interval
+        )
+
+    def reschedule(self, user_id, now, default):
+        "Records the poll of the user and schedules the next one"
+        self._last_poll_times[user_id] = now
+        self._push(user_id, now + self.interval(user_id, now, default))
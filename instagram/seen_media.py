@@ -0,0 +1,48 @@
+"""
+Remembers the media processed before, so the overlapping
+feed windows do not download the same posts again.
+"""
+import time
+import calendar
+
+from common.bloom_filter import BloomFilter
+from common.logger import logger
+from instagram_database.db import SeenMedia
+
+SEEN_MEDIA_CAPACITY = 10000
+
+
+class SeenMediaRegistry:
+    """
+        A bloom filter in front of the seen_media table. Most of the
+        media are new, the filter answers them without a query.
+    """
+
+    def __init__(self, database):
+        self._db = database
+        self._bloom = None
+        self._load()
+
+    def _load(self, capacity=SEEN_MEDIA_CAPACITY):
+        media_ids = [media.id for media in self._db.select(SeenMedia)]
+        self._bloom = BloomFilter(max(capacity, 2 * len(media_ids)))
+        for media_id in media_ids:
+            self._bloom.add(media_id)
+        logger.debug("%d seen media loaded", len(media_ids))
+
+    def __contains__(self, media_id):
+        media_id = int(media_id)
+        if media_id not in self._bloom:
+            return False
+        return len(self._db.select(SeenMedia, SeenMedia.id == media_id)) == 1
+
+    def add(self, media_id):
+        "Marks the media as processed"
+        media_id = int(media_id)
+        if media_id in self:
+            return
+
+        self._db.insert(SeenMedia(media_id, calendar.timegm(time.gmtime())))
+        self._bloom.add(media_id)
+        if self._bloom.is_full:
+            self._load(capacity=2 * self._bloom.capacity)
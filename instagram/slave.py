@@ -5,20 +5,31 @@ post in the other account.
 """
 import os
 import time
+from queue import Queue, Empty
 import calendar
-import urllib
-import shutil
-
-from instagram.duplicate import is_any_photo_shared
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from instagram.dedup_pool import DedupPool
+from instagram.engagement import EngagementStats
+from instagram.ranking import PostRanker, score_post
+from instagram.scheduler import PollScheduler
+from instagram.downloader import MediaDownloader
 from instagram.base import BaseInstagram, MediaTypes
+from instagram.seen_media import SeenMediaRegistry
 import settings
 from common import exceptions
-from common.tools import LockDir, raise_exception_by_message
+from common.tools import LockDir, raise_exception_by_message, \
+    remove_folder
 from common.logger import logger
-from instagram_database.db import User, DB, get_realtime_setting
+from instagram_database.db import User, SyncCheckpoint, FeedCursor, \
+    UserStats, DB, get_realtime_setting
 from OCR.ocr import convert_jpg_to_text
 
 
+FOLLOWINGS_CHECKPOINT = 1
+
+
 class SlaveInstagram(BaseInstagram):
     "Slave instagram user"
 
@@ -26,6 +37,18 @@ class SlaveInstagram(BaseInstagram):
         super().__init__(username, password, queue, **kwargs)
         self._db = DB()
         self._users = []
+        self._stats = {}
+        self._changed_stats = set()
+        self._cursors = {}
+        self._changed_cursors = set()
+        self._scheduler = PollScheduler(
+            settings.MIN_POLL_INTERVAL_S, settings.MAX_POLL_INTERVAL_S
+        )
+        self._dedup_pool = None
+        self._downloader = None
+        self._seen_media = SeenMediaRegistry(self._db)
+        # Posts passed the duplicate check on their previews
+        self._unique_posts = Queue()
 
     @property
     def users(self):
@@ -33,99 +56,346 @@ class SlaveInstagram(BaseInstagram):
         return self._users
 
     def _start(self):
-        cycle = get_realtime_setting('LOAD_EVERY_X_CYCLE', int)
+        self._dedup_pool = DedupPool(settings.DEDUP_PROCESSES)
+        self._downloader = MediaDownloader(
+            settings.DOWNLOAD_WORKERS, settings.DOWNLOADS_PER_HOST,
+            # Uses the same proxy with the api, if set
+            proxies=self.s.proxies
+        )
+        try:
+            self._start_cycles()
+        finally:
+            self._downloader.close()
+            self._dedup_pool.close()
+            self._discard_unique_posts()
+
+    def _start_cycles(self):
+        """
+            Polls the users when they are due. The database is loaded
+            every LOAD_EVERY_X_CYCLE * WAIT_TIME_S seconds.
+        """
+        load_time = 0
         while self.is_active:
             wait_time_s = get_realtime_setting('WAIT_TIME_S', int)
-            if cycle >= get_realtime_setting('LOAD_EVERY_X_CYCLE', int):
+            now = calendar.timegm(time.gmtime())
+            if now >= load_time:
                 logger.info("Updating")
-                self.load()
-                cycle = 0
-
-            logger.info("Retreiving medias...")
-            for user in self.users:
-                posts = self.get_posts(user.id, wait_time_s, post_count=-1)
-                if posts is None:
-                    # Something went wrong
-                    continue
-
-                logger.info("Downloading posts for user %s", user.name)
-                self.download_images(user.name, posts)
-            cycle += 1
-
-            self._wait_with_log("WAIT_TIME_S")
+                if self.load():
+                    load_time = now + wait_time_s * get_realtime_setting(
+                        'LOAD_EVERY_X_CYCLE', int
+                    )
+                else:
+                    load_time = now + settings.RATE_LIMIT_PAUSE_S
+                self._scheduler.sync([user.id for user in self.users], now)
+
+            due_users = [
+                self.get_user_by_id(user_id)
+                for user_id in self._scheduler.pop_due(now)
+            ]
+            if due_users:
+                self._poll_users(due_users, wait_time_s, now)
+
+            next_due_time = self._scheduler.next_due_time()
+            self._wait_until(
+                load_time if next_due_time is None
+                else min(next_due_time, load_time)
+            )
 
-    def _update_database(self):
-        self.getSelfUsersFollowing()
-        followings = self.LastJson["users"].copy()
+    def _poll_users(self, users, wait_time_s, now):
+        """
+            Downloads the best new posts of the users and schedules
+            their next polls. The posts passed the filter of their
+            users are ranked together, the best TOP_K_POSTS are kept.
+        """
+        logger.info("Retreiving medias of %d users...", len(users))
+        ranker = PostRanker(settings.TOP_K_POSTS)
+        candidate_count = 0
+        for user, posts in self._fetch_posts(users, wait_time_s, now):
+            # Something went wrong if posts is None, tries on the next poll
+            for item, urls in posts or ():
+                ranker.push(
+                    score_post(item, user.follower_count, now),
+                    (user.name, item, urls)
+                )
+                candidate_count += 1
+            self._scheduler.reschedule(user.id, now, wait_time_s)
+        logger.info(
+            "%d of %d candidate posts are ranked in", len(ranker),
+            candidate_count
+        )
 
-        self._clear_unfollowed_users(followings)
+        posts_of_users = {}
+        items = {}
+        for username, item, urls in ranker.ranked():
+            posts_of_users.setdefault(username, []).append(urls)
+            items[str(item["pk"])] = item
+        failed_keys = []
+        for username, posts in posts_of_users.items():
+            logger.info("Downloading posts for user %s", username)
+            failed_keys.extend(self.download_images(username, posts))
+        failed_keys.extend(self.download_originals(wait=True))
+        for key in failed_keys:
+            self._rewind_cursor(items[key])
+        self._save_stats()
+        self._save_cursors()
+
+    def _fetch_posts(self, users, wait_time_s, now):
+        """
+            Fetches the feeds of the users concurrently, the rate limiter
+            of the account paces them. Yields (user, posts) in order.
+        """
+        with ThreadPoolExecutor(
+                max_workers=settings.FEED_FETCH_WORKERS,
+                thread_name_prefix="feed_fetcher") as executor:
+            futures = [
+                (user, executor.submit(
+                    self.get_posts, user.id, wait_time_s, post_count=-1,
+                    lookback_s=self._scheduler.lookback(
+                        user.id, now, wait_time_s
+                    )
+                ))
+                for user in users
+            ]
+            for user, future in futures:
+                try:
+                    yield user, future.result()
+                except exceptions.WaitAFewMinutes:
+                    logger.warning(
+                        "Server asked to wait, pausing the requests for %d seconds",
+                        settings.RATE_LIMIT_PAUSE_S
+                    )
+                    self.rate_limiter.pause(settings.RATE_LIMIT_PAUSE_S)
+                    yield user, None
 
+    @staticmethod
+    def _is_user_stale(user, now):
+        """
+            Returns True if the stats of the user are older than its TTL.
+            The TTL is spread by the user id, so the users do not expire
+            all in the same cycle.
+        """
+        ttl = settings.USER_INFO_TTL_S
+        ttl += ttl * (int(user.id) % 10) // 20
+        return now - int(float(user.last_update_time)) >= ttl
+
+    def iter_followings(self, max_id=''):
+        """
+            Walks every page of the followings with max_id cursors.
+            Yields the users of a page with the cursor of the next
+            page, the cursor is None for the last page.
+        """
+        while True:
+            self.getUserFollowings(self.username_id, maxid=max_id)
+            try:
+                users = self.LastJson["users"]
+            except KeyError as error:
+                raise_exception_by_message(self.LastJson, error)
+
+            max_id = self.LastJson.get("next_max_id")
+            yield users, str(max_id) if max_id else None
+            if not max_id:
+                return
+
+    def _refresh_users(self, followings, users_in_db, now):
+        """
+            Returns the refreshed records of the new or stale users.
+            The feed is fetched only for the users without enough
+            running stats, the others need one request.
+        """
+        updated_users = []
         for user in followings:
+            user_in_db = users_in_db.get(user["pk"])
+            if user_in_db is not None and \
+                    user_in_db.name == user["username"] and \
+                    not self._is_user_stale(user_in_db, now):
+                continue
+
             self.searchUsername(user["username"])
             user = self.LastJson["user"]
 
-            mean_like_count, mean_comment_count = self.get_user_info(
-                user["pk"], check_on=100)
+            stats = self._stats.get(user["pk"])
+            if stats is None or \
+                    stats.samples < settings.ENGAGEMENT_MIN_SAMPLES:
+                stats = self.get_user_info(user["pk"], check_on=100)
+                self._stats[stats.user_id] = stats
+                self._changed_stats.add(stats.user_id)
 
-            user_in_db = User(
+            updated_users.append(User(
                 user["pk"],
                 user["username"],
-                calendar.timegm(time.gmtime()),
+                now,
                 user["follower_count"],
-                mean_like_count,
-                mean_comment_count,
+                int(stats.like_mean),
+                int(stats.comment_mean),
                 "General"
+            ))
+        return updated_users
+
+    def _get_checkpoint(self):
+        checkpoints = self._db.select(
+            SyncCheckpoint, SyncCheckpoint.id == FOLLOWINGS_CHECKPOINT
+        )
+        return checkpoints[0].max_id if checkpoints else ''
+
+    def _set_checkpoint(self, max_id):
+        checkpoint = SyncCheckpoint(
+            FOLLOWINGS_CHECKPOINT, max_id, calendar.timegm(time.gmtime())
+        )
+        if max_id:
+            self._db.upsert([checkpoint])
+        else:
+            self._db.delete(checkpoint)
+
+    def _update_database(self):
+        """
+            Syncs the followings page by page, the cursor is saved after
+            each page. Returns False if the server asked to wait, the
+            next call resumes from the saved cursor.
+        """
+        max_id = self._get_checkpoint()
+        is_resumed = bool(max_id)
+        if is_resumed:
+            logger.info("Resuming the followings sync from %s", max_id)
+
+        users_in_db = {user.id: user for user in self._db.select(User)}
+        self._stats = {
+            stats.id: EngagementStats.from_record(stats)
+            for stats in self._db.select(UserStats)
+        }
+        now = calendar.timegm(time.gmtime())
+        following_ids = set()
+        updated_user_count = 0
+        try:
+            for followings, next_max_id in self.iter_followings(max_id):
+                following_ids.update(user["pk"] for user in followings)
+                updated_users = self._refresh_users(
+                    followings, users_in_db, now
+                )
+                self._db.upsert(updated_users)
+                self._save_stats()
+                updated_user_count += len(updated_users)
+                self._set_checkpoint(next_max_id)
+        except exceptions.WaitAFewMinutes:
+            logger.warning(
+                "Followings sync paused after %d users, it will be resumed",
+                len(following_ids)
             )
-            is_user_exists = len(
-                self._db.select(User, User.id == user_in_db.id)
-            ) == 1
+            self.rate_limiter.pause(settings.RATE_LIMIT_PAUSE_S)
+            return False
 
-            if is_user_exists:
-                self._db.update(user_in_db)
-            else:
-                self._db.insert(user_in_db)
-        logger.debug("Database updated")
+        # The users of the pages before a resume are not known here
+        if not is_resumed:
+            self._clear_unfollowed_users(following_ids)
+        logger.debug(
+            "Database updated, %d of %d users refreshed",
+            updated_user_count, len(following_ids)
+        )
+        return True
 
-    def _clear_unfollowed_users(self, followings):
-        followings = [user["pk"] for user in followings]
+    def _clear_unfollowed_users(self, following_ids):
         for user in self._db.select(User):
-            if user.id not in followings:
+            if user.id not in following_ids:
                 self._db.delete(user)
+                stats = self._stats.pop(user.id, None)
+                if stats is not None:
+                    self._db.delete(stats.to_record())
+                cursor = self._cursors.pop(user.id, None)
+                if cursor is not None:
+                    self._db.delete(cursor)
+
+    def _save_stats(self):
+        "Saves the running stats changed since the last save"
+        self._db.upsert([
+            self._stats[user_id].to_record() for user_id in self._changed_stats
+        ])
+        self._changed_stats.clear()
+
+    def _get_stats(self, user):
+        "Returns the running stats of the user"
+        if user.id not in self._stats:
+            # The user is refreshed before the running stats existed
+            self._stats[user.id] = EngagementStats(
+                user.id,
+                like_mean=float(user.mean_like_count),
+                comment_mean=float(user.mean_comment_count)
+            )
+        return self._stats[user.id]
+
+    def _update_stats(self, media, max_timestamp):
+        """
+            Adds the posts older than max_timestamp into the running
+            stats, their counts are settled enough by then.
+        """
+        for item in sorted(media, key=lambda item: item["taken_at"]):
+            if item["taken_at"] > max_timestamp:
+                break
+            user = self.get_user_by_id(item["user"]["pk"])
+            if self._get_stats(user).update(item):
+                self._changed_stats.add(user.id)
+
+    def _save_cursors(self):
+        "Saves the feed cursors advanced since the last save"
+        self._db.upsert([
+            self._cursors[user_id] for user_id in self._changed_cursors
+        ])
+        self._changed_cursors.clear()
+
+    def _advance_cursor(self, media, max_timestamp):
+        """
+            Moves the cursor of the user to the newest post older than
+            max_timestamp. The newer ones are requested again until then.
+        """
+        mature_media = [
+            (item["taken_at"], item["pk"], item["user"]["pk"])
+            for item in media if item["taken_at"] <= max_timestamp
+        ]
+        if not mature_media:
+            return
+
+        taken_at, media_id, user_id = max(mature_media)
+        cursor = self._cursors.get(user_id)
+        if cursor is None or \
+                (taken_at, media_id) > (cursor.taken_at, cursor.media_id):
+            self._cursors[user_id] = FeedCursor(user_id, taken_at, media_id)
+            self._changed_cursors.add(user_id)
+
+    def _rewind_cursor(self, item):
+        "Moves the cursor of the user before the post, so it is fetched again"
+        user_id = item["user"]["pk"]
+        cursor = self._cursors.get(user_id)
+        if cursor is not None and (item["taken_at"], item["pk"]) <= \
+                (cursor.taken_at, cursor.media_id):
+            self._cursors[user_id] = FeedCursor(
+                user_id, item["taken_at"] - 1, 0
+            )
+            self._changed_cursors.add(user_id)
 
     def get_user_info(self, user_id, check_on=100):
-        "Returns the basic user information"
+        "Returns the engagement stats of the last check_on posts of the user"
         self.getUserFeed(user_id)
         try:
             media = self.LastJson["items"].copy()
         except KeyError as error:
             raise_exception_by_message(self.LastJson, error)
 
-        if not media:
-            return 0, 0
-
-        total_likes = 0
-        total_comments = 0
-        index = 0
-        for index, item in enumerate(media):
-            if index == check_on:
-                break
-            total_likes += item["like_count"]
-            try:
-                total_comments += item["comment_count"]
-            except KeyError:
-                # Comments are disabled
-                pass
-
-        return int(total_likes / index), int(total_comments / index)
+        self._scheduler.observe(user_id, [item["taken_at"] for item in media])
+        return EngagementStats.from_feed(user_id, media[:check_on])
 
     def load(self):
-        "Loads database and the users"
-        self._update_database()
+        "Loads database and the users, returns False if the sync is paused"
+        # Loaded first, the sync removes the cursors of the unfollowed users
+        self._cursors = {
+            cursor.id: cursor for cursor in self._db.select(FeedCursor)
+        }
+        is_synced = self._update_database()
         self._users = self._db.select(User)
+        for cursor in self._cursors.values():
+            self._scheduler.observe(cursor.id, [cursor.taken_at])
         logger.debug(
             "Users are: %s",
             ' '.join([str(user) for user in self._users])
         )
+        return is_synced
 
     def get_user_by_id(self, user_id):
         "Returns the user which saved in the database"
@@ -134,10 +404,25 @@ class SlaveInstagram(BaseInstagram):
                 return user
         raise exceptions.NoSuchUser(user_id)
 
-    def get_posts(self, user_id, wait_time_s, post_count=-1):
-        "Gets the post for given user"
+    def get_posts(self, user_id, wait_time_s, post_count=-1, lookback_s=None):
+        """
+            Gets the post for given user. lookback_s is the time since
+            the last poll, WAIT_TIME_S by default. If the user has a
+            cursor, the media newer than it are requested, back to
+            MAX_POLL_INTERVAL_S at most.
+        """
+        if lookback_s is None:
+            lookback_s = wait_time_s
         # Set how much time we go back
-        min_timestamp = calendar.timegm(time.gmtime()) - (wait_time_s * 2)
+        max_timestamp = calendar.timegm(time.gmtime()) - wait_time_s
+        min_timestamp = max_timestamp - lookback_s
+        cursor = self._cursors.get(user_id)
+        if cursor is not None:
+            # Behind the window if a failed download rewound it
+            min_timestamp = max(
+                cursor.taken_at, max_timestamp - settings.MAX_POLL_INTERVAL_S
+            )
+
         self.getUserFeed(user_id, minTimestamp=min_timestamp)
         # Copy the response in case of changes
         try:
@@ -145,17 +430,43 @@ class SlaveInstagram(BaseInstagram):
         except KeyError as error:
             raise_exception_by_message(self.LastJson, error)
 
+        if cursor is not None:
+            # The media taken at the cursor time are in the response too
+            media = [
+                item for item in media
+                if (item["taken_at"], item["pk"]) >
+                (cursor.taken_at, cursor.media_id)
+            ]
+
         return self.get_media_urls(
             media, post_count,
-            max_timestamp=min_timestamp + wait_time_s,
+            max_timestamp=max_timestamp,
         )
 
     @staticmethod
     def _get_url(item):
+        """
+            Returns the original url, the media type and the url of the
+            smallest version with both sides at least PREVIEW_MIN_SIDE.
+            The duplicate check needs that much detail, the original
+            is the preview if no version is large enough.
+        """
         try:
-            return item["video_versions"][0]["url"], MediaTypes.VIDEO
+            versions, media_type = item["video_versions"], MediaTypes.VIDEO
         except KeyError:
-            return item["image_versions2"]["candidates"][0]["url"], MediaTypes.PHOTO
+            versions = item["image_versions2"]["candidates"]
+            media_type = MediaTypes.PHOTO
+
+        large_enough = [
+            version for version in versions
+            if min(version.get("width", 0), version.get("height", 0)) >=
+            settings.PREVIEW_MIN_SIDE
+        ]
+        preview = min(
+            large_enough or versions[:1],
+            key=lambda version: version.get("width", 0) * version.get("height", 0)
+        )
+        return versions[0]["url"], media_type, preview["url"]
 
     def _is_media_filtered(self, item, **filters):
         max_timestamp = filters.pop("max_timestamp")
@@ -169,30 +480,33 @@ class SlaveInstagram(BaseInstagram):
             logger.debug("The media will be filtered on max_timestamp")
             return True
 
-        user = self.get_user_by_id(item["user"]["pk"])
+        stats = self._get_stats(self.get_user_by_id(item["user"]["pk"]))
+        std_factor = settings.ENGAGEMENT_STD_FACTOR
         try:
+            comment_threshold = stats.comment_threshold(std_factor)
             logger.debug(
-                "Media has %d comments, avarage comment count is %d",
-                item["comment_count"], user.mean_comment_count
+                "Media has %d comments, comment threshold is %.1f",
+                item["comment_count"], comment_threshold
             )
-            if item["comment_count"] < user.mean_comment_count:
+            if item["comment_count"] < comment_threshold:
                 logger.debug("The media will be filtered on comment count")
                 return True
         except KeyError:
             pass
 
+        like_threshold = stats.like_threshold(std_factor)
         logger.debug(
-            "Media has %d likes, avarage like count is %d",
-            item["like_count"], user.mean_like_count
+            "Media has %d likes, like threshold is %.1f",
+            item["like_count"], like_threshold
         )
-        if item["like_count"] < user.mean_like_count:
+        if item["like_count"] < like_threshold:
             logger.debug("The media will be filtered on like count")
             return True
 
         return False
 
     def get_media_urls(self, media, post_count, **filters):
-        "Yields the urls for given media"
+        "Yields the items passed the filter with their urls"
         try:
             if post_count <= 0:
                 # A little trick to prevent code duplication
@@ -205,6 +519,10 @@ class SlaveInstagram(BaseInstagram):
                 break
 
             key = str(item["pk"])
+            if item["pk"] in self._seen_media:
+                logger.debug("The media %s is processed before", key)
+                post_count += 1
+                continue
             if self._is_media_filtered(item, **filters):
                 post_count += 1
                 continue
@@ -214,68 +532,165 @@ class SlaveInstagram(BaseInstagram):
             except KeyError:
                 for carousel_media in item["carousel_media"]:
                     urls[key].append(self._get_url(carousel_media))
-            yield urls
+            yield item, urls
+
+        # After the filter, so a post is not compared with itself
+        self._update_stats(media, filters["max_timestamp"])
+        self._advance_cursor(media, filters["max_timestamp"])
+        if media:
+            self._scheduler.observe(
+                media[0]["user"]["pk"], [item["taken_at"] for item in media]
+            )
 
-    @staticmethod
-    def download_image(url, path, filename):
-        "Downloads the image"
+    def download_image(self, url, path, filename):
+        "Downloads the image, returns the text in it or None on failure"
+        filepath = os.path.join(path, filename)
         try:
-            urllib.request.urlretrieve(url, filename=filename)
-        except urllib.error.URLError:
-            # If download fails, skip others and clean
-            os.chdir(settings.BASE_DIR)
-            shutil.rmtree(path)
+            self._downloader.fetch(url, filepath)
+        except exceptions.DownloadFailed as error:
+            logger.error(error)
             return None
 
-        text_in_image = convert_jpg_to_text(
-            os.path.join(path, filename),
-            'TURKISH'
-        )
+        text_in_image = convert_jpg_to_text(filepath, 'TURKISH')
         if text_in_image.strip():
             logger.warning("The text of the image is: %s", text_in_image)
         return text_in_image
 
+    # pylint: disable=too-many-arguments
+    def _start_post_download(self, path, username, key, media, *,
+                             preview=False, skip_previews=False):
+        """
+            Starts the downloads of a post, the smallest versions if
+            preview. If skip_previews, the media whose preview is the
+            original are not downloaded again.
+        """
+        futures = []
+        for index, (url, media_type, preview_url) in enumerate(media):
+            if skip_previews and preview_url == url:
+                continue
+            filename = f"{index}_{key}_{username}{MediaTypes.get_extension(media_type)}"
+
+            futures.append(self._downloader.submit(
+                self.download_image,
+                preview_url if preview else url, path, filename
+            ))
+        return futures
+
+    @staticmethod
+    def _finish_post_download(path, futures):
+        """
+            Waits the downloads of a post. If any of them failed, the
+            folder is removed and None is returned. Otherwise returns
+            the count of the downloaded media.
+        """
+        texts = [future.result() for future in futures]
+        if None in texts:
+            # If download fails, skip others and clean
+            logger.error("Image download failed.")
+            try:
+                remove_folder(path)
+            except OSError as error:
+                logger.error("%s could not be removed: %s", path, error)
+            return None
+        return len(texts)
+
+    def download_originals(self, wait=False):
+        """
+            Downloads the originals of the posts passed the duplicate
+            check on their previews. If wait, waits the pending checks.
+            A post is marked as seen once its originals are in place,
+            returns the keys of the posts failed to download.
+        """
+        downloads = []
+        while True:
+            try:
+                path, lock, username, key, media = self._unique_posts.get(
+                    timeout=1 if wait and self._dedup_pool.pending_count else 0
+                )
+            except Empty:
+                if wait and self._dedup_pool.pending_count:
+                    continue
+                break
+
+            logger.debug("Downloading the originals of %s", key)
+            downloads.append((
+                path, lock, key, self._start_post_download(
+                    path, username, key, media, skip_previews=True
+                )
+            ))
+
+        failed_keys = []
+        for path, lock, key, futures in downloads:
+            if self._finish_post_download(path, futures) is None:
+                failed_keys.append(key)
+                continue
+            self._seen_media.add(key)
+            lock.release()
+        return failed_keys
+
+    def _discard_unique_posts(self):
+        """
+            Removes the folders of the posts whose check ended after the
+            last cycle. They have only the previews and are not marked as
+            seen, their cursors are not saved, so they are fetched again.
+        """
+        while True:
+            try:
+                path = self._unique_posts.get_nowait()[0]
+            except Empty:
+                break
+            logger.warning("%s has only the previews, removing", path)
+            try:
+                remove_folder(path)
+            except OSError as error:
+                logger.error("%s could not be removed: %s", path, error)
+
     def download_images(self, username, media_urls):
-        "Downloads the images from given url list"
-        downloaded_media_count = 0
-        is_shared_before = False
+        """
+            Downloads the images from given url list. A post is marked
+            as seen once its originals are handed to the duplicate check,
+            returns the keys of the posts failed to download.
+        """
+        low_resolution_first = settings.LOW_RESOLUTION_FIRST
+
+        # Start every post first, so they are downloaded in parallel
+        downloads = []
         for item in media_urls:
             key = list(item)[0]
 
             path = os.path.join(settings.DOWNLOADS, f"downloaded_images_{key}")
 
             os.makedirs(path, exist_ok=True)
-            with LockDir(path):
-                os.chdir(path)
+            # The lock is released by the dedup pool after the check
+            lock = LockDir(path)
+            lock.lock()
 
-                for index, (url, media_type) in enumerate(item[key]):
-                    filename = f"{index}_{key}_{username}{MediaTypes.get_extension(media_type)}"
-
-                    text_in_image = self.download_image(url, path, filename)
-                    if text_in_image is None:
-                        # Failed to download image
-                        logger.error("Image download failed.")
-                        continue
+            futures = self._start_post_download(
+                path, username, key, item[key], preview=low_resolution_first
+            )
+            downloads.append((path, lock, key, item[key], futures))
 
-                    downloaded_media_count += 1
+        downloaded_media_count = 0
+        failed_keys = []
+        for path, lock, key, media, futures in downloads:
+            media_count = self._finish_post_download(path, futures)
+            if media_count is None:
+                failed_keys.append(key)
+                continue
+            downloaded_media_count += media_count
 
-            if is_any_photo_shared(path):
-                logger.warning(
-                    "The image shared before, filtered on image"
-                )
-                is_shared_before = True
-
-            os.chdir(settings.BASE_DIR)
-            if is_shared_before:
-                for _ in range(10):
-                    try:
-                        shutil.rmtree(path)
-                    except PermissionError:
-                        time.sleep(0.5)
-                    else:
-                        break
+            if low_resolution_first:
+                # Marked as seen after the originals
+                self._dedup_pool.submit(path, lock, on_unique=functools.partial(
+                    self._unique_posts.put, (path, lock, username, key, media)
+                ))
+            else:
+                self._dedup_pool.submit(path, lock)
+                self._seen_media.add(key)
+        failed_keys.extend(self.download_originals())
 
         logger.info("%s media has been downloaded.", downloaded_media_count)
+        return failed_keys
 
     def send_request(self, endpoint, post=None, login=False):
         "Sends the request to the endpoint"
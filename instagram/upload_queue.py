@@ -0,0 +1,187 @@
+"""
+The upload jobs of the master. They are kept in the database, so
+a post is neither lost nor shared twice when the master restarts.
+The media pk is the key of a job, a post is queued only once.
+
+A video is transcoded by the server after its upload. Its job
+waits in the transcoding state meanwhile, so the other jobs are
+not blocked.
+"""
+import time
+import calendar
+
+from common.logger import logger
+from instagram_database.db import UploadJob, Transcode
+
+PENDING = "pending"
+UPLOADING = "uploading"
+TRANSCODING = "transcoding"
+DONE = "done"
+FAILED = "failed"
+
+
+def _now():
+    return calendar.timegm(time.gmtime())
+
+
+class UploadQueue:
+    "Upload jobs with their states, retried with an exponential backoff"
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, database, attempts, backoff_s,
+                 transcode_wait_s, transcode_deadline_s):
+        self._db = database
+        self.attempts = attempts
+        self.backoff_s = backoff_s
+        self.transcode_wait_s = transcode_wait_s
+        self.transcode_deadline_s = transcode_deadline_s
+        # The earliest time a waiting job is due, None if no job
+        self._due_time = None
+        self._update_due_time()
+
+    def _jobs(self, *states, limit=None):
+        "Returns the jobs in the states, the earliest due first"
+        return self._db.select_where(
+            UploadJob, f"state IN ({', '.join('?' * len(states))})",
+            states, order_by="next_attempt_time", limit=limit
+        )
+
+    def _due_jobs(self, state, limit=None):
+        return self._db.select_where(
+            UploadJob, "state = ? AND next_attempt_time <= ?",
+            (state, _now()), order_by="next_attempt_time", limit=limit
+        )
+
+    def _update_due_time(self):
+        jobs = self._jobs(PENDING, TRANSCODING, limit=1)
+        self._due_time = int(jobs[0].next_attempt_time) if jobs else None
+
+    def _delete_transcode(self, job):
+        for transcode in self._db.select(Transcode, Transcode.id == job.id):
+            self._db.delete(transcode)
+
+    def has_due_jobs(self):
+        "Returns True if a pending or transcoding job can be tried now"
+        return self._due_time is not None and self._due_time <= _now()
+
+    def recover(self):
+        """
+            Puts back the jobs interrupted by a restart and returns them.
+            Their uploads may be done, but there is no way to know it.
+        """
+        now = _now()
+        jobs = self._jobs(UPLOADING)
+        for job in jobs:
+            job.state = PENDING
+            job.next_attempt_time = now
+            job.update_time = now
+        self._db.upsert(jobs)
+        if jobs:
+            logger.warning("%d interrupted uploads will be retried", len(jobs))
+        self._update_due_time()
+        return jobs
+
+    def enqueue(self, media_id, folder):
+        "Queues the folder of the media once, returns its job"
+        jobs = self._db.select(UploadJob, UploadJob.id == media_id)
+        if jobs:
+            return jobs[0]
+
+        now = _now()
+        job = UploadJob(media_id, folder, PENDING, 0, now, now)
+        self._db.insert(job)
+        logger.debug("Upload job %d is queued", media_id)
+        if self._due_time is None or now < self._due_time:
+            self._due_time = now
+        return job
+
+    def claim(self, count):
+        "Marks the earliest count due jobs as uploading and returns them"
+        now = _now()
+        jobs = self._due_jobs(PENDING, count)
+        for job in jobs:
+            job.state = UPLOADING
+            job.update_time = now
+        self._db.upsert(jobs)
+        self._update_due_time()
+        return jobs
+
+    def claim_transcodes(self):
+        "Returns the due transcoding jobs with their uploaded videos"
+        return [
+            (job, self._db.select(Transcode, Transcode.id == job.id)[0])
+            for job in self._due_jobs(TRANSCODING)
+        ]
+
+    def transcode(self, job, upload_id, video):
+        "Makes the job wait the transcode of its uploaded video"
+        now = _now()
+        self._db.upsert([Transcode(
+            job.id, upload_id, video,
+            now + self.transcode_deadline_s, self.transcode_wait_s
+        )])
+        job.state = TRANSCODING
+        job.next_attempt_time = now + self.transcode_wait_s
+        job.update_time = now
+        self._db.upsert([job])
+        self._update_due_time()
+
+    def retry_transcode(self, job, transcode):
+        """
+            Waits the transcode longer. Past the deadline the job fails,
+            its video is uploaded again on the retry.
+        """
+        now = _now()
+        if now >= int(transcode.deadline):
+            self._delete_transcode(job)
+            return self.fail(job, "the video is not transcoded in time")
+
+        transcode.wait_s = min(
+            int(transcode.wait_s) * 2, int(transcode.deadline) - now
+        )
+        self._db.upsert([transcode])
+        job.next_attempt_time = now + transcode.wait_s
+        job.update_time = now
+        self._db.upsert([job])
+        self._update_due_time()
+        logger.debug(
+            "Upload job %s is not transcoded yet, retrying in %d seconds",
+            job.id, transcode.wait_s
+        )
+        return job.state
+
+    def succeed(self, job):
+        "Marks the job as done"
+        self._delete_transcode(job)
+        job.state = DONE
+        job.update_time = _now()
+        self._db.upsert([job])
+        self._update_due_time()
+
+    def fail(self, job, reason):
+        """
+            Schedules the job to be retried later, marks it as failed
+            after the last attempt. Returns the state of the job.
+        """
+        now = _now()
+        job.attempts = int(job.attempts) + 1
+        job.update_time = now
+        if job.attempts >= self.attempts:
+            job.state = FAILED
+            logger.error(
+                "Upload job %s failed after %d attempts: %s",
+                job.id, job.attempts, reason
+            )
+        else:
+            job.state = PENDING
+            job.next_attempt_time = \
+                now + self.backoff_s * 2 ** (job.attempts - 1)
+            logger.warning(
+                "Upload job %s failed(%d), retrying at %s: %s",
+                job.id, job.attempts,
+                time.strftime('%H:%M:%S', time.localtime(job.next_attempt_time)),
+                reason
+            )
+        self._db.upsert([job])
+        self._update_due_time()
+        return job.state
@@ -0,0 +1,154 @@
+"""
+Reads the duration and the size of a video for its configure.
+
+The MP4 boxes moov/mvhd and moov/trak/tkhd have them, so they
+are parsed directly without starting ffmpeg. moviepy is used
+only for the files the parser does not understand.
+"""
+import os
+import struct
+import hashlib
+import threading
+from collections import namedtuple, deque
+
+from moviepy.editor import VideoFileClip
+
+from common.logger import logger
+
+VideoInfo = namedtuple("VideoInfo", ["duration", "width", "height"])
+
+HASH_BLOCK_SIZE = 64 * 1024
+CACHE_SIZE = 128
+
+_HEADER = struct.Struct(">I4s")
+_LARGE_SIZE = struct.Struct(">Q")
+_CONTAINERS = (b"moov", b"trak")
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class NotMP4(ValueError):
+    "The file has no boxes to read the video information"
+
+
+def _iter_boxes(video_file, start, end):
+    "Yields the type, the payload offset and the payload size of the boxes"
+    offset = start
+    while offset + _HEADER.size <= end:
+        video_file.seek(offset)
+        size, box_type = _HEADER.unpack(video_file.read(_HEADER.size))
+        header_size = _HEADER.size
+        if size == 1:
+            size, = _LARGE_SIZE.unpack(video_file.read(_LARGE_SIZE.size))
+            header_size += _LARGE_SIZE.size
+        elif size == 0:
+            # Extends to the end of the file
+            size = end - offset
+        if size < header_size:
+            raise NotMP4(f"Invalid size of the box {box_type!r}")
+
+        yield box_type, offset + header_size, size - header_size
+        offset += size
+
+
+def _read_mvhd(payload):
+    "Returns the duration in seconds"
+    if payload[0] == 1:
+        timescale, duration = struct.unpack_from(">IQ", payload, 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", payload, 12)
+    if not timescale:
+        raise NotMP4("The timescale is zero")
+    return duration / timescale
+
+
+def _read_tkhd(payload):
+    "Returns the width and the height, rotated by the track matrix"
+    # The matrix and the size are after the times, longer in version 1
+    offset = 40 if payload[0] == 1 else 28
+    matrix = struct.unpack_from(">9i", payload, offset + 12)
+    width, height = struct.unpack_from(">II", payload, offset + 48)
+    width, height = width >> 16, height >> 16
+    # Rotated by 90 or 270 degrees
+    if matrix[0] == 0 and matrix[4] == 0:
+        width, height = height, width
+    return width, height
+
+
+def probe_mp4(path):
+    "Returns the video information from the boxes of the MP4 file"
+    duration = None
+    size = None
+    with open(path, "rb") as video_file:
+        # Breadth first from the left, the tracks are visited in order
+        boxes = deque([(b"", 0, os.path.getsize(path))])
+        while boxes:
+            _, start, length = boxes.popleft()
+            for box_type, offset, payload_size in _iter_boxes(
+                    video_file, start, start + length):
+                if box_type in _CONTAINERS:
+                    boxes.append((box_type, offset, payload_size))
+                    continue
+                if box_type not in (b"mvhd", b"tkhd"):
+                    continue
+
+                video_file.seek(offset)
+                payload = video_file.read(min(payload_size, 128))
+                if box_type == b"mvhd":
+                    duration = _read_mvhd(payload)
+                elif size is None or not all(size):
+                    # The audio tracks have no size
+                    size = _read_tkhd(payload)
+
+    if duration is None or size is None or not all(size):
+        raise NotMP4("No movie or video track header")
+    return VideoInfo(duration, *size)
+
+
+def probe_with_moviepy(path):
+    "Returns the video information with ffmpeg"
+    clip = VideoFileClip(path)
+    try:
+        return VideoInfo(clip.duration, *clip.size)
+    finally:
+        clip.reader.close()
+        # The clips without sound have no audio
+        if clip.audio is not None:
+            clip.audio.reader.close_proc()
+
+
+def _file_key(path):
+    """
+        Returns a hash of the size, the first and the last blocks of
+        the file. Cheaper than hashing the whole video, enough to tell
+        the downloaded videos apart.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as video_file:
+        digest.update(video_file.read(HASH_BLOCK_SIZE))
+        video_file.seek(max(size - HASH_BLOCK_SIZE, 0))
+        digest.update(video_file.read(HASH_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def video_info(path):
+    "Returns the duration and the size of the video, cached by its hash"
+    key = _file_key(path)
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+
+    try:
+        info = probe_mp4(path)
+    except (NotMP4, struct.error, IndexError) as error:
+        logger.warning("%s could not be parsed, using moviepy: %s", path, error)
+        info = probe_with_moviepy(path)
+
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            # The oldest one
+            del _cache[next(iter(_cache))]
+        _cache[key] = info
+    return info
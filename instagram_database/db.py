@@ -2,6 +2,7 @@
 import os
 import sqlite3
 import re
+from contextlib import closing
 
 from sqlite_orm.database import Database
 from sqlite_orm.field import IntegerField, TextField, BaseField
@@ -151,6 +152,68 @@ class User(_CustomBaseTable):
     category = TextField(default_value="General")
 
 
+class SeenMedia(_CustomBaseTable):
+    "The media which are processed before"
+    __table_name__ = 'seen_media'
+
+    id = IntegerField(primary_key=True)
+    seen_time = TextField(not_null=True)
+
+
+class SyncCheckpoint(_CustomBaseTable):
+    "The cursors of the interrupted paginated syncs"
+    __table_name__ = 'sync_checkpoints'
+
+    id = IntegerField(primary_key=True)
+    max_id = TextField(not_null=True)
+    update_time = TextField(not_null=True)
+
+
+class FeedCursor(_CustomBaseTable):
+    "The newest processed media of the users"
+    __table_name__ = 'feed_cursors'
+
+    id = IntegerField(primary_key=True)
+    taken_at = IntegerField(not_null=True)
+    media_id = IntegerField(not_null=True)
+
+
+class UserStats(_CustomBaseTable):
+    "The running engagement statistics of the users"
+    __table_name__ = 'user_stats'
+
+    id = IntegerField(primary_key=True)
+    like_mean = TextField(not_null=True)
+    like_variance = TextField(not_null=True)
+    comment_mean = TextField(not_null=True)
+    comment_variance = TextField(not_null=True)
+    samples = IntegerField(not_null=True)
+    last_taken_at = IntegerField(not_null=True)
+
+
+class UploadJob(_CustomBaseTable):
+    "The upload jobs of the master, the id is the media pk"
+    __table_name__ = 'upload_jobs'
+
+    id = IntegerField(primary_key=True)
+    folder = TextField(not_null=True)
+    state = TextField(not_null=True)
+    attempts = IntegerField(not_null=True)
+    next_attempt_time = IntegerField(not_null=True)
+    update_time = TextField(not_null=True)
+
+
+class Transcode(_CustomBaseTable):
+    "The uploaded videos of the upload jobs waiting their transcodes"
+    __table_name__ = 'transcodes'
+
+    id = IntegerField(primary_key=True)
+    upload_id = TextField(not_null=True)
+    video = TextField(not_null=True)
+    deadline = IntegerField(not_null=True)
+    wait_s = IntegerField(not_null=True)
+
+
 class Settings(_CustomBaseTable):
     "The Settings table"
     __table_name__ = 'settings'
@@ -165,13 +228,26 @@ class Settings(_CustomBaseTable):
 
 class DB:
     "The main database object"
-    tables = (User, Settings,)
+    tables = (
+        User, SeenMedia, SyncCheckpoint, FeedCursor, UserStats, UploadJob,
+        Transcode, Settings,
+    )
+    # The queried columns of the tables growing without a limit
+    indexes = (
+        ("upload_jobs_due", UploadJob, ("state", "next_attempt_time")),
+    )
+    _is_tables_checked = False
 
     def __init__(self):
         is_db_exists = os.path.isfile(settings.DB_NAME)
         self._db = Database(settings.DB_NAME)
         if not is_db_exists:
             self._create_db_for_first_use()
+        elif not DB._is_tables_checked:
+            self._create_missing_tables()
+        if not DB._is_tables_checked:
+            self._create_indexes()
+        DB._is_tables_checked = True
 
     @property
     def database(self):
@@ -197,6 +273,30 @@ class DB:
                 )
         self.insert(Settings())
 
+    def _create_missing_tables(self):
+        "Creates the tables added after the database is created"
+        with closing(sqlite3.connect(settings.DB_NAME)) as connection:
+            existing_tables = {
+                row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"
+                )
+            }
+        for table in self.tables:
+            if table.__table_name__ not in existing_tables:
+                logger.debug("Creating table %s", table.__table_name__)
+                self.database.query(table).create().execute()
+
+    def _create_indexes(self):
+        "Creates the indexes, the existing ones are skipped"
+        with closing(sqlite3.connect(settings.DB_NAME)) as connection:
+            with connection:
+                for name, table, columns in self.indexes:
+                    connection.execute(
+                        "CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+                            name, table.__table_name__, ", ".join(columns)
+                        )
+                    )
+
     def select(self, select_from, *condition_expressions, logical_operator='AND'):
         "Returns the values from database based on conditions"
         query = self._db.query(select_from).select()
@@ -213,10 +313,53 @@ class DB:
             result_list.append(select_from(*res))
         return result_list
 
+    # pylint: disable=too-many-arguments
+    def select_where(self, select_from, where, params=(),
+                     order_by=None, limit=None):
+        """
+            Returns the records matching the SQL condition, for the
+            queries the ORM cannot filter, order or limit.
+        """
+        fields = select_from.fields()
+        statement = "SELECT {0} FROM {1} WHERE {2}".format(
+            ", ".join(fields), select_from.__table_name__, where
+        )
+        params = tuple(params)
+        if order_by is not None:
+            statement += " ORDER BY " + order_by
+        if limit is not None:
+            statement += " LIMIT ?"
+            params += (limit,)
+        with closing(sqlite3.connect(settings.DB_NAME)) as connection:
+            return [
+                select_from(*row)
+                for row in connection.execute(statement, params)
+            ]
+
     def insert(self, obj):
         "Inserts the record"
         self.database.query().insert(obj).execute()
 
+    def upsert(self, objs):
+        "Inserts or replaces the records of a table in one transaction"
+        if not objs:
+            return
+
+        table = objs[0].__class__
+        fields = table.fields()
+        statement = "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(
+            table.__table_name__,
+            ", ".join(fields),
+            ", ".join("?" * len(fields))
+        )
+        with closing(sqlite3.connect(settings.DB_NAME)) as connection:
+            # Commits at the end, rolls back on error
+            with connection:
+                connection.executemany(statement, [
+                    tuple(getattr(obj, field) for field in fields)
+                    for obj in objs
+                ])
+
     def delete(self, obj):
         "Deletes record from database based on id"
         self.database.query(obj.__class__).delete().filter(
@@ -24,12 +24,34 @@ MASTER_PASSWORD = None
 DOWNLOADS = os.path.join(BASE_DIR, "downloads")
 SHARED = os.path.join(BASE_DIR, "shared")
 DEFAULT_THUMBNAIL = os.path.join(BASE_DIR, "default_thumbnail.jpg")
+FINGERPRINT_INDEX = os.path.join(BASE_DIR, "shared_fingerprints.npz")
 
 # Times
 WAIT_TIME_S = 60 * 60  # Seconds
 LOAD_EVERY_X_CYCLE = 12
 WAIT_SECS = 10
 LISTENER_WAIT_TIME = 60  # Seconds
+USER_INFO_TTL_S = 24 * 60 * 60  # Seconds, how long the user stats are valid
+
+# Duplicate check
+DEDUP_PROCESSES = None  # None means the CPU count
+# Checks the smallest versions first, downloads originals of unique posts
+LOW_RESOLUTION_FIRST = True
+# Pixels, smaller previews are too coarse for the duplicate check
+PREVIEW_MIN_SIDE = 320
+
+# Engagement filter
+ENGAGEMENT_EWMA_ALPHA = 0.1  # Weight of the newest post in the running stats
+# A post passes with mean + factor * std likes/comments, 0 means the mean
+ENGAGEMENT_STD_FACTOR = 0
+# The feed is not fetched on refresh once the stats have this many posts
+ENGAGEMENT_MIN_SAMPLES = 10
+
+# Polling
+MIN_POLL_INTERVAL_S = 10 * 60  # Seconds, for the users posting often
+MAX_POLL_INTERVAL_S = 24 * 60 * 60  # Seconds, for the quiet users
+# Only the best posts of a poll are downloaded, ranked across the users
+TOP_K_POSTS = 20
 
 # Logging
 LOGGER_NAME = "instagram_post_share"
@@ -37,5 +59,25 @@ LOG_LEVEL = logging.DEBUG
 FILENAME = "instagram_post_share_app.log"
 FORMAT = "%(levelname)s:%(processName)s:%(filename)s:%(funcName)s:%(lineno)d:: %(message)s"
 
+# Requests of an account
+REQUESTS_PER_SECOND = 0.5
+REQUEST_BURST = 5
+RATE_LIMIT_PAUSE_S = 5 * 60  # Seconds, after "Please wait a few minutes"
+FEED_FETCH_WORKERS = 4
+
+# Downloads
+DOWNLOAD_WORKERS = 8
+DOWNLOADS_PER_HOST = 4
+
+# Uploads
+UPLOAD_ATTEMPTS = 5
+UPLOAD_BACKOFF_S = 60  # Seconds, doubled on each retry
+VIDEO_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes, read and sent at a time
+VIDEO_CHUNK_WORKERS = 1  # Chunks sent in parallel
+VIDEO_CHUNK_ATTEMPTS = 3
+# The configure of a video is retried until the server transcodes it
+TRANSCODE_WAIT_S = 5  # Seconds, doubled on each retry
+TRANSCODE_DEADLINE_S = 10 * 60  # Seconds
+
 # Proxy
 DEFAULT_PROXY = None